@@ -1,3 +1,31 @@
-from .embeddings import Embeddings
-from .relatedness import Relatedness
-from .serviecs.embeddings import EmbeddingsAPI
+import importlib
+from typing import TYPE_CHECKING
+
+# the public classes and their modules, imported on first access so that e.g. the HTTP clients or `semeval.download`
+# do not load gensim, scipy or the web framework
+_LAZY = {
+    'Embeddings': 'semeval.embeddings',
+    'Relatedness': 'semeval.relatedness',
+    'EmbeddingsAPI': 'semeval.serviecs.embeddings',
+    'RelatednessAPI': 'semeval.serviecs.relatedness',
+}
+
+__all__ = list(_LAZY)
+
+if TYPE_CHECKING:
+    from .embeddings import Embeddings
+    from .relatedness import Relatedness
+    from .serviecs.embeddings import EmbeddingsAPI
+    from .serviecs.relatedness import RelatednessAPI
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        value = getattr(importlib.import_module(_LAZY[name]), name)
+        globals()[name] = value  # later accesses do not go through __getattr__
+        return value
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,410 @@
+import argparse
+import asyncio
+import io
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from .common import *
+
+# the sizes of the synthetic models and of the workload, see the command line options
+DEFAULTS = {
+    'language': 'eng',
+    'words': 20000,
+    'dim': 100,
+    'rel_rows': 5000,
+    'rel_cols': 5000,
+    'rel_density': 0.01,
+    'queries': 200,
+    'loads': 3,
+    'requests': 500,
+    'concurrency': 8,
+    'client_requests': 2000,
+    'client_delay': 0.001,
+    'import_runs': 5,
+    'seed': 0,
+}
+
+# heavy dependencies, which only the models and the servers need
+HEAVY_MODULES = ['gensim', 'scipy', 'hickle', 'h5py', 'sklearn', 'fastapi', 'starlette', 'pydantic', 'uvicorn']
+
+# statements whose import time is measured, and whether they must not load any heavy module
+IMPORTS = {
+    'package': ('import semeval', True),
+    'client': ('from semeval import EmbeddingsAPI, RelatednessAPI', True),
+    'download': ('import semeval.download', True),
+    'embeddings': ('from semeval import Embeddings', False),
+    'relatedness': ('from semeval import Relatedness', False),
+}
+
+
+def synthetic_words(n):
+    return ["w{}".format(i) for i in range(n)]
+
+
+def write_synthetic_embeddings(path, n_words, dim, seed=0, chunk_size=10000):
+    """
+    Writes random vectors of `n_words` words `w0`, `w1`... in the word2vec text format.
+    """
+    rng = np.random.RandomState(seed)
+    words = synthetic_words(n_words)
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(u"{} {}\n".format(n_words, dim))
+        for start in range(0, n_words, chunk_size):
+            chunk = rng.standard_normal((min(chunk_size, n_words - start), dim)).astype(np.float32)
+            buf = io.StringIO()
+            np.savetxt(buf, chunk, fmt='%.5f')
+            f.writelines(w + ' ' + line + '\n'
+                         for w, line in zip(words[start:start + len(chunk)], buf.getvalue().splitlines()))
+    return path
+
+
+def write_synthetic_relatedness(paths, n_rows, n_cols, density, seed=0):
+    """
+    Writes a random sparse relatedness model: the row and column terms (the first `n_rows` and `n_cols` of `w0`,
+     `w1`..., the words of the synthetic embeddings) and the hickle CSR matrix of positive scores.
+
+    :param paths: the paths of the model, see `convert.relatedness_paths`
+    """
+    import hickle as hkl
+    from scipy import sparse
+
+    for key, n in [('rows', n_rows), ('cols', n_cols)]:
+        with io.open(paths[key], 'w', encoding='utf-8') as f:
+            f.writelines(w + '\n' for w in synthetic_words(n))
+    matrix = sparse.random(n_rows, n_cols, density=density, format='csr', dtype=np.float32,
+                           random_state=np.random.RandomState(seed))
+    hkl.dump(matrix, paths['model'], mode='w', compression='gzip')
+    return paths
+
+
+def measure(fn, calls, warmup=True):
+    """
+    Calls `fn` with every argument tuple of `calls` and summarizes the times taken in milliseconds. With `warmup`, the
+     first call is made once more beforehand and not counted.
+    """
+    calls = list(calls)
+    if warmup and calls:
+        fn(*calls[0])
+    times = []
+    for args in calls:
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def summarize(times, wall_time=None):
+    times = np.array(times) * 1000
+    wall_time = wall_time if wall_time is not None else times.sum() / 1000
+    return {
+        'calls': len(times),
+        'mean_ms': float(times.mean()),
+        'median_ms': float(np.median(times)),
+        'p95_ms': float(np.percentile(times, 95)),
+        'min_ms': float(times.min()),
+        'per_second': len(times) / wall_time if wall_time > 0 else None,
+    }
+
+
+def bench_embeddings(config, rng):
+    from . import convert
+    from .embeddings import Embeddings
+
+    lang = config['language']
+    results = {
+        'embeddings.load': measure(lambda: Embeddings(lang), [()] * config['loads'], warmup=False),
+        'embeddings.compile': measure(convert.compile_embeddings, [(lang,)], warmup=False),
+        'embeddings.load_mmap': measure(lambda: Embeddings(lang, mmap=True), [()] * config['loads'], warmup=False),
+    }
+
+    e = Embeddings(lang, mmap=True)
+    words = synthetic_words(config['words'])
+    sample = lambda n: [words[i] for i in rng.randint(0, len(words), n)]
+    n = config['queries']
+    results['embeddings.similarity'] = measure(e.similarity, zip(sample(n), sample(n)))
+    results['embeddings.neighbours'] = measure(e.neighbours, [(w,) for w in sample(n)])
+    results['embeddings.neighbours_threshold'] = measure(e.neighbours_threshold, [(w, 0.3) for w in sample(n)])
+    results['embeddings.analogy'] = measure(e.analogy, zip(sample(n), sample(n), sample(n)))
+    results['embeddings.to_vector'] = measure(e.to_vector, [(sample(20),) for _ in range(n)])
+    return results, e
+
+
+def bench_relatedness(config, rng):
+    from . import convert
+    from .relatedness import Relatedness
+
+    lang = config['language']
+    results = {
+        'relatedness.load': measure(lambda: Relatedness(lang), [()] * config['loads'], warmup=False),
+        'relatedness.compile': measure(convert.compile_relatedness, [(lang,)], warmup=False),
+        'relatedness.load_mmap': measure(lambda: Relatedness(lang, mmap=True), [()] * config['loads'], warmup=False),
+    }
+
+    r = Relatedness(lang, cache_size=0)  # every call computes its row
+    rows, cols = synthetic_words(config['rel_rows']), synthetic_words(config['rel_cols'])
+    sample = lambda terms, n: [terms[i] for i in rng.randint(0, len(terms), n)]
+    n = config['queries']
+    results['relatedness.get_sorted_rel'] = measure(lambda w: r.get_sorted_rel(w, k=100),
+                                                    [(w,) for w in sample(rows, n)])
+    results['relatedness.interpret'] = measure(r.interpret, zip(sample(rows, n), sample(rows, n)))
+    results['relatedness.metaphoricity'] = measure(
+        lambda t, v, expression: r.metaphoricity(t, v, expression, k=min(300, len(r.rows) - 1)),
+        zip(sample(rows, n), sample(rows, n), [sample(cols, 10) for _ in range(n)]))
+    return results
+
+
+def bench_server(config, e, rng):
+    """
+    Latency of sequential requests and throughput of `concurrency` concurrent clients of an `EmbeddingsServer` serving
+     the already loaded model, called in process through its ASGI interface.
+    """
+    import httpx
+    from .serviecs.embeddings import EmbeddingsServer
+
+    lang = config['language']
+    app = EmbeddingsServer(models={lang: e})
+    words = synthetic_words(config['words'])
+    sample = lambda: words[rng.randint(0, len(words))]
+    endpoints = {
+        'similarity': lambda: ('/similarity/', {'lang': lang, 'w1': sample(), 'w2': sample()}),
+        'neighbours': lambda: ('/neighbours/', {'lang': lang, 'word': sample(), 'threshold': 0.3}),
+        'analogy': lambda: ('/analogy/', {'lang': lang, 'a': sample(), 'b': sample(), 'c': sample()}),
+        'to_vector': lambda: ('/to_vector/', {'lang': lang, 'tokens': [sample() for _ in range(20)]}),
+    }
+
+    async def call(client, request):
+        path, params = request
+        start = time.perf_counter()
+        response = await client.get(path, params=params)
+        if response.status_code != 200:
+            raise Exception("{} failed with {}: {}".format(path, response.status_code, response.text))
+        return time.perf_counter() - start
+
+    async def run():
+        results = {}
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+            for name, request in endpoints.items():
+                times = [await call(client, request()) for _ in range(config['queries'])]
+                results['server.{}.latency'.format(name)] = summarize(times)
+
+                queue = [request() for _ in range(config['requests'])]
+                times = []
+
+                async def worker():
+                    while queue:
+                        times.append(await call(client, queue.pop()))
+
+                start = time.perf_counter()
+                await asyncio.gather(*[worker() for _ in range(config['concurrency'])])
+                results['server.{}.throughput'.format(name)] = summarize(times, time.perf_counter() - start)
+        return results
+
+    return asyncio.run(run())
+
+
+def bench_client(config):
+    """
+    Compares the request strategies of `EmbeddingsAPI` against a local stand-in of the server, which answers every
+     request with a fixed JSON body after `client_delay` seconds. Every word is queried 10 times.
+    """
+    import requests
+    import threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from .serviecs.embeddings import EmbeddingsAPI
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True  # as uvicorn, otherwise kept-alive connections wait for delayed ACKs
+
+        def do_GET(self):
+            time.sleep(config['client_delay'])
+            body = b'[["hey", 0.69], ["hello", 0.61]]'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    n, workers = config['client_requests'], config['concurrency']
+    words = synthetic_words(max(n // 10, 1)) * 10
+    url = 'http://localhost:{}/neighbours'.format(port)
+    try:
+        api = EmbeddingsAPI(port=port, pool_size=workers)
+        start = time.perf_counter()
+        list(api.map('neighbours', [(w,) for w in words], max_workers=workers))
+        mapped = time.perf_counter() - start
+        return {
+            'client.new_connection': measure(lambda w: requests.get(url, {'word': w, 'lang': 'eng'}),
+                                             [(w,) for w in words]),
+            'client.pooled': measure(EmbeddingsAPI(port=port).neighbours, [(w,) for w in words]),
+            'client.pooled_cache': measure(EmbeddingsAPI(port=port, cache_size=n).neighbours, [(w,) for w in words],
+                                           warmup=False),
+            'client.map': summarize([mapped / len(words)] * len(words), mapped),
+        }
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_imports(config):
+    """
+    The time taken by the `IMPORTS` statements in fresh interpreters and the heavy modules they load. The lightweight
+     entry points report the heavy modules they should not have loaded as `unexpected_modules`.
+    """
+    code = ("import sys, time, json\n"
+            "start = time.perf_counter()\n"
+            "{}\n"
+            "seconds = time.perf_counter() - start\n"
+            "print(json.dumps([seconds, [m for m in {!r} if m in sys.modules]]))")
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(script_path('')))] +
+                                        ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    results = {}
+    for name, (statement, light) in IMPORTS.items():
+        times = []
+        for _ in range(config['import_runs']):
+            out = subprocess.check_output([sys.executable, '-c', code.format(statement, HEAVY_MODULES)], env=env)
+            seconds, loaded = json.loads(out.decode().strip().splitlines()[-1])
+            times.append(seconds)
+        results['import.' + name] = dict(summarize(times), heavy_modules=loaded,
+                                         unexpected_modules=loaded if light else [])
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=script_path(''),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception as e:
+        return None
+
+
+def run(output=None, data_dir=None, models=True, server=True, imports=True, client=True, **kwargs):
+    """
+    Generates synthetic models of the configured size (see `DEFAULTS`) and times loading them and the methods of
+     `Embeddings` and `Relatedness`, and optionally the latency and throughput of the embeddings server, the request
+     strategies of the client and the import time of the package. The models are written to `data_dir`, or to a
+     temporary directory removed afterwards, which is used as `SEMEVAL_DATA`.
+
+    :param output: JSON file the results are written to
+    :return: the configuration and environment of the run and the timings of every benchmark
+    """
+    config = dict(DEFAULTS, **{k: v for k, v in kwargs.items() if v is not None})
+    report = {
+        'meta': {
+            'commit': _commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'config': config,
+        },
+        'results': {},
+    }
+    if imports:
+        report['results'].update(bench_imports(config))
+    if client and models:
+        report['results'].update(bench_client(config))
+    if not models:
+        return _write(report, output)
+
+    previous = os.environ.get('SEMEVAL_DATA')
+    tmp = tempfile.TemporaryDirectory() if data_dir is None else None
+    os.environ['SEMEVAL_DATA'] = data_dir or tmp.name
+    try:
+        from . import convert
+        os.makedirs(download_path(), exist_ok=True)
+        rng = np.random.RandomState(config['seed'])
+        write_synthetic_embeddings(convert.embeddings_paths(config['language'])['text'], config['words'],
+                                   config['dim'], seed=config['seed'])
+        write_synthetic_relatedness(convert.relatedness_paths(config['language']), config['rel_rows'],
+                                    config['rel_cols'], config['rel_density'], seed=config['seed'])
+
+        results, e = bench_embeddings(config, rng)
+        results.update(bench_relatedness(config, rng))
+        if server:
+            results.update(bench_server(config, e, rng))
+        report['results'].update(results)
+    finally:
+        if previous is None:
+            del os.environ['SEMEVAL_DATA']
+        else:
+            os.environ['SEMEVAL_DATA'] = previous
+        if tmp is not None:
+            tmp.cleanup()
+
+    return _write(report, output)
+
+
+def _write(report, output):
+    if output:
+        with io.open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def compare(baseline, current, tolerance=0.1):
+    """
+    The relative change of the mean time of every benchmark of two reports (or paths of JSON reports), and the names of
+     the benchmarks more than `tolerance` slower than in the baseline.
+    """
+    reports = []
+    for report in (baseline, current):
+        if isinstance(report, str):
+            with io.open(report, 'r', encoding='utf-8') as f:
+                report = json.load(f)
+        reports.append(report['results'])
+    baseline, current = reports
+
+    changes = {name: current[name]['mean_ms'] / baseline[name]['mean_ms'] - 1
+               for name in sorted(set(baseline) & set(current)) if baseline[name]['mean_ms'] > 0}
+    return changes, [name for name, change in changes.items() if change > tolerance]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='semeval benchmark the library and the server on synthetic models')
+    parser.add_argument('-o', '--output', default=None, help='JSON file the results are written to')
+    parser.add_argument('--compare', default=None, help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative slowdown reported as a regression when comparing (default: 0.1)')
+    parser.add_argument('--data-dir', default=None,
+                        help='directory the synthetic models are written to and kept (default: a temporary one)')
+    parser.add_argument('--no-server', action='store_true', help='skip the server benchmarks')
+    parser.add_argument('--no-imports', action='store_true', help='skip the import time benchmarks')
+    parser.add_argument('--no-client', action='store_true',
+                        help='skip the client benchmarks against a local stand-in server')
+    parser.add_argument('--imports-only', action='store_true',
+                        help='only measure the import time, and fail if a lightweight entry point loads a heavy module')
+    for key, value in DEFAULTS.items():
+        parser.add_argument('--' + key.replace('_', '-'), type=type(value), default=None,
+                            help='(default: {})'.format(value))
+    args = parser.parse_args()
+
+    report = run(output=args.output, data_dir=args.data_dir, models=not args.imports_only, server=not args.no_server,
+                 imports=not args.no_imports, client=not args.no_client,
+                 **{key: getattr(args, key) for key in DEFAULTS})
+    for name, stats in report['results'].items():
+        print("{:45s} mean {:10.3f} ms  p95 {:10.3f} ms  {:10.1f}/s".format(name, stats['mean_ms'], stats['p95_ms'],
+                                                                          stats['per_second'] or 0))
+    unexpected = {name: stats['unexpected_modules'] for name, stats in report['results'].items()
+                  if stats.get('unexpected_modules')}
+    for name, modules in unexpected.items():
+        print("{:45s} loads {}".format(name, ', '.join(modules)))
+    regressions = []
+    if args.compare:
+        changes, regressions = compare(args.compare, report, args.tolerance)
+        for name, change in changes.items():
+            print("{:45s} {:+.1%}{}".format(name, change, "  REGRESSION" if name in regressions else ""))
+    if unexpected or regressions:
+        sys.exit(1)
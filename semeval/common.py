@@ -1,7 +1,132 @@
 from mikatools import *
+import threading
+import time
+from collections import OrderedDict
 
 
 def supported_languages(): return ['eng', 'fin', 'rus', 'myv', 'mdf', 'kpv', 'sms', 'liv']
 
 
-def download_path(): return script_path("data/")
+def download_path():
+    """
+    The directory the models are downloaded to and read from, `semeval/data/` unless the `SEMEVAL_DATA` environment
+     variable names another one.
+    """
+    path = os.environ.get('SEMEVAL_DATA')
+    return os.path.join(path, '') if path else script_path("data/")
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping bounded to `maxsize` entries and, optionally, to `max_bytes` (using the sizes given to `put`)
+     that evicts the least recently used entries. Entries older than `ttl` seconds, if given, are dropped when read.
+     It counts hits, misses, evictions and expirations.
+    """
+
+    def __init__(self, maxsize=1024, max_bytes=None, ttl=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._data = OrderedDict()  # key: (value, size, expiry time)
+        self._lock = threading.RLock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def _expired(self, key):
+        return self.ttl is not None and self._data[key][2] < time.monotonic()
+
+    def _remove(self, key):
+        self.bytes -= self._data.pop(key)[1]
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data and self._expired(key):
+                self._remove(key)
+                self.expirations += 1
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, size=0):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            expiry = time.monotonic() + self.ttl if self.ttl is not None else None
+            self._data[key] = (value, size, expiry)
+            self.bytes += size
+            while self._data and ((self.maxsize is not None and len(self._data) > self.maxsize) or
+                                  (self.max_bytes is not None and self.bytes > self.max_bytes)):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data and not self._expired(key)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'expirations': self.expirations,
+                'size': len(self._data), 'maxsize': self.maxsize, 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                'ttl': self.ttl}
+
+
+# functions called with (method, phase, seconds) by the timers of the instrumented methods, see `add_timing_hook`
+_timing_hooks = []
+
+
+def add_timing_hook(hook):
+    """
+    Registers a function called with the name of a method (e.g. 'embeddings.neighbours_threshold'), the name of a
+     phase of it ('lookup', 'compute' or 'serialize') and the seconds it took, every time an instrumented method of
+     `Embeddings` or `Relatedness` runs. Without hooks the methods are not timed.
+    """
+    if hook not in _timing_hooks:
+        _timing_hooks.append(hook)
+    return hook
+
+
+def remove_timing_hook(hook):
+    if hook in _timing_hooks:
+        _timing_hooks.remove(hook)
+
+
+class PhaseTimer(object):
+    """
+    Reports the time elapsed since the previous mark (or the creation of the timer) to the timing hooks at every mark.
+    """
+
+    def __init__(self, method, hooks):
+        self.method = method
+        self.hooks = hooks
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        for hook in self.hooks:
+            hook(self.method, phase, now - self.last)
+        self.last = time.perf_counter()
+
+
+class _NullTimer(object):
+    def mark(self, phase):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def timer(method):
+    """
+    A `PhaseTimer` of a method if timing hooks are registered, otherwise a timer that does nothing.
+    """
+    return PhaseTimer(method, list(_timing_hooks)) if _timing_hooks else NULL_TIMER
@@ -0,0 +1,409 @@
+import argparse
+import hashlib
+import io
+import numpy as np
+from .common import *
+
+# number of rows normalized at a time when writing the unit-length matrix
+CHUNK_SIZE = 65536
+
+
+def variant_name(max_vocab=None, vocab=None):
+    """
+    The name of the compiled files of a pruned model: `top{max_vocab}` and a hash of the allowed words.
+    """
+    parts = []
+    if max_vocab:
+        parts.append("top{}".format(max_vocab))
+    if vocab is not None:
+        digest = hashlib.sha1('\n'.join(sorted(set(vocab))).encode('utf-8')).hexdigest()
+        parts.append("vocab-" + digest[:12])
+    return '.'.join(parts)
+
+
+def embeddings_paths(lang, max_vocab=None, vocab=None):
+    """
+    Paths of the text vectors and of the compiled files written next to them: the float32 matrix, its L2-normalized
+     copy (used for similarity searches), the vocabulary, one word per line in matrix order, the same words as
+     memory-mappable `Vocabulary` arrays, and the optional approximate nearest neighbour index. The compiled files of
+     a pruned model (see `compile_embeddings`) have the variant name in their path.
+    """
+    base = "{}vectors-{}".format(download_path(), lang)
+    variant = variant_name(max_vocab, vocab)
+    compiled = base + "." + variant if variant else base
+    return {
+        'text': base + ".txt",
+        'vectors': compiled + ".npy",
+        'norm': compiled + ".norm.npy",
+        'vocab': compiled + ".vocab.txt",
+        'words': compiled + ".words.",
+        'index': compiled + ".ivf.npz",
+    }
+
+
+def is_compiled(lang, max_vocab=None, vocab=None):
+    paths = embeddings_paths(lang, max_vocab, vocab)
+    return all(os.path.isfile(paths[k]) for k in ['vectors', 'norm', 'vocab'])
+
+
+def select_rows(words, max_vocab=None, vocab=None):
+    """
+    The words among the first `max_vocab` words (all if None) that are in the allow-list `vocab` (all if None), and
+     their rows: a slice, so that selecting them from a memory-mapped matrix copies nothing, or an array of indices.
+     `words` is a list or a `Vocabulary`, whose allowed words are looked up instead of scanning all of its words.
+    """
+    from .vocabulary import Vocabulary
+
+    n = min(len(words), max_vocab) if max_vocab else len(words)
+    if vocab is None:
+        return words.head(n) if isinstance(words, Vocabulary) else words[:n], slice(0, n)
+    if isinstance(words, Vocabulary):
+        rows = np.unique(words.indices(set(vocab)))
+        rows = rows[(rows >= 0) & (rows < n)]
+        return words.terms(rows), rows
+    allowed = set(vocab)
+    rows = np.array([i for i, w in enumerate(words[:n]) if w in allowed], dtype=np.int64)
+    return [words[i] for i in rows], rows
+
+
+def _parse_text(f, dim, n_rows, unicode_errors='replace', allowed=None):
+    """
+    Yields the words and vectors of the first `n_rows` lines of word2vec text vectors, skipping the words that are
+     repeated or not `allowed`. The vectors of skipped words are not parsed.
+    """
+    seen = set()
+    for line_no in range(n_rows):
+        line = f.readline()
+        if line == b'':
+            raise EOFError("unexpected end of input; is count incorrect or file otherwise damaged?")
+        word, _, values = line.rstrip().decode('utf-8', errors=unicode_errors).partition(' ')
+        if word in seen or (allowed is not None and word not in allowed):  # keep the first occurrence, as gensim does
+            continue
+        values = values.split(' ')
+        if len(values) != dim:
+            raise ValueError("invalid vector on line {} (is this really the text format?)".format(line_no))
+        seen.add(word)
+        yield word, np.asarray(values, dtype=np.float32)
+
+
+def read_embeddings(lang, max_vocab=None, vocab=None, unicode_errors='replace'):
+    """
+    Reads only the selected rows of the text vectors of a language (see `select_rows`), parsing stops after
+     `max_vocab` lines. Returns the words and their vectors.
+    """
+    paths = embeddings_paths(lang)
+    allowed = set(vocab) if vocab is not None else None
+    with io.open(paths['text'], 'rb') as f:
+        n_words, dim = (int(x) for x in f.readline().split())
+        n_rows = min(n_words, max_vocab) if max_vocab else n_words
+        vectors = np.empty((min(n_rows, len(allowed)) if allowed is not None else n_rows, dim), dtype=np.float32)
+        words = []
+        for word, vector in _parse_text(f, dim, n_rows, allowed=allowed, unicode_errors=unicode_errors):
+            vectors[len(words)] = vector
+            words.append(word)
+    return words, vectors[:len(words)]
+
+
+def _l2_normalize(vectors, out):
+    for start in range(0, vectors.shape[0], CHUNK_SIZE):
+        m = vectors[start:start + CHUNK_SIZE]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dist = np.sqrt((m ** 2).sum(-1))[..., np.newaxis]
+            out[start:start + CHUNK_SIZE] = (m / dist).astype(np.float32)
+
+
+def compile_embeddings(lang, unicode_errors='replace', max_vocab=None, vocab=None):
+    """
+    Parses `vectors-{lang}.txt` once and writes it in a format that can be memory-mapped by `Embeddings(lang, mmap=True)`.
+     The text file is streamed, so the conversion never holds more than one copy of the matrix in memory.
+
+    :param max_vocab: compile only the first (most frequent) words, parsing stops after them
+    :param vocab: compile only the words of this allow-list; the model is then opened with
+     `Embeddings(lang, mmap=True, max_vocab=max_vocab, vocab=vocab)`
+    """
+    from .vocabulary import Vocabulary
+
+    paths = embeddings_paths(lang, max_vocab, vocab)
+    if not os.path.isfile(paths['text']):
+        raise Exception("Vectors for language '{}' are not downloaded! "
+                        "Download them using `python -m semeval.download -m {} -l {}`"
+                        .format(lang, 'embeddings', lang))
+
+    allowed = set(vocab) if vocab is not None else None
+    with io.open(paths['text'], 'rb') as f:
+        n_words, dim = (int(x) for x in f.readline().split())
+        n_rows = min(n_words, max_vocab) if max_vocab else n_words
+        vectors = np.lib.format.open_memmap(paths['vectors'], mode='w+', dtype=np.float32, shape=(n_rows, dim))
+
+        words = []
+        for word, vector in _parse_text(f, dim, n_rows, allowed=allowed, unicode_errors=unicode_errors):
+            vectors[len(words)] = vector
+            words.append(word)
+
+    vectors.flush()
+    del vectors
+
+    if len(words) != n_rows:  # words were skipped, rewrite the matrix without the unused tail
+        full = np.load(paths['vectors'], mmap_mode='r')
+        tmp_path = paths['vectors'] + ".tmp"
+        trimmed = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(len(words), dim))
+        for start in range(0, len(words), CHUNK_SIZE):
+            trimmed[start:start + CHUNK_SIZE] = full[start:min(start + CHUNK_SIZE, len(words))]
+        trimmed.flush()
+        del trimmed, full
+        os.replace(tmp_path, paths['vectors'])
+
+    vectors = np.load(paths['vectors'], mmap_mode='r')
+    norm = np.lib.format.open_memmap(paths['norm'], mode='w+', dtype=np.float32, shape=vectors.shape)
+    _l2_normalize(vectors, norm)
+    norm.flush()
+    del norm
+
+    with io.open(paths['vocab'], 'w', encoding='utf-8', newline='\n') as f:
+        f.write('\n'.join(words))
+    Vocabulary.from_terms(words).save(paths['words'])
+
+    return paths
+
+
+def load_embeddings(lang, mmap_mode='r', max_vocab=None, vocab=None):
+    """
+    Opens the compiled files of a language and returns the vocabulary, the vectors and the normalized vectors. A pruned
+     model is read from its own compiled files if they exist, otherwise its rows are selected from the full model.
+     The vocabulary is the memory-mapped `Vocabulary` of the words, or their list when it was compiled without one.
+    """
+    from .vocabulary import Vocabulary
+
+    if (max_vocab or vocab is not None) and not is_compiled(lang, max_vocab, vocab):
+        words, vectors, norm = load_embeddings(lang, mmap_mode)
+        words, rows = select_rows(words, max_vocab, vocab)
+        return words, vectors[rows], norm[rows]
+
+    paths = embeddings_paths(lang, max_vocab, vocab)
+    if not is_compiled(lang, max_vocab, vocab):
+        raise Exception("Compiled vectors for language '{}' were not found! "
+                        "Compile them using `python -m semeval.convert -m {} -l {}`"
+                        .format(lang, 'embeddings', lang))
+
+    if Vocabulary.exists(paths['words']):
+        words = Vocabulary.load(paths['words'], mmap_mode=mmap_mode)
+    else:
+        with io.open(paths['vocab'], 'r', encoding='utf-8', newline='\n') as f:
+            content = f.read()
+        words = content.split('\n') if content else []
+    vectors = np.load(paths['vectors'], mmap_mode=mmap_mode)
+    norm = np.load(paths['norm'], mmap_mode=mmap_mode)
+    return words, vectors, norm
+
+
+def relatedness_paths(lang):
+    """
+    Paths of the downloaded relatedness model (the row and column terms and the hickle matrix) and of the raw CSR
+     arrays of the matrix, its l1 row norms and the compact vocabularies of its terms (prefixes of the arrays of a
+     `Vocabulary`) written by `compile_relatedness`.
+    """
+    base = "{}{}-relatedness-".format(download_path(), lang)
+    return {
+        'rows': base + "rows.txt",
+        'cols': base + "cols.txt",
+        'model': base + "model.hkl",
+        'indptr': base + "indptr.npy",
+        'indices': base + "indices.npy",
+        'data': base + "data.npy",
+        'shape': base + "shape.npy",
+        'norms': base + "norms.npy",
+        'rows_vocab': base + "rows.",
+        'cols_vocab': base + "cols.",
+    }
+
+
+def is_relatedness_compiled(lang):
+    paths = relatedness_paths(lang)
+    return all(os.path.isfile(paths[k]) for k in ['indptr', 'indices', 'data', 'shape'])
+
+
+def compile_relatedness(lang):
+    """
+    Decompresses the hickle matrix of a language once and writes its CSR arrays as `.npy` files, which
+     `Relatedness(lang, mmap=True)` opens lazily with memory mapping.
+    """
+    import hickle as hkl
+    from scipy import sparse
+    from .relatedness import l1_row_norms
+
+    paths = relatedness_paths(lang)
+    if not os.path.isfile(paths['model']):
+        raise Exception(
+            "Relatedness models are not download. Download them using `python -m semeval.download -m relatedness -l {}`"
+                .format(lang)
+        )
+
+    matrix = sparse.csr_matrix(hkl.load(paths['model']))
+    matrix.sum_duplicates()  # sorted indices without duplicates, rows are read straight from the arrays
+    # scipy checks the contents of int64 indices to see if they fit in int32, which would read the whole mapped file
+    index_dtype = np.int32 if max(matrix.shape + (matrix.nnz,)) < np.iinfo(np.int32).max else np.int64
+    np.save(paths['indptr'], matrix.indptr.astype(index_dtype))
+    np.save(paths['indices'], matrix.indices.astype(index_dtype))
+    np.save(paths['data'], matrix.data)
+    np.save(paths['shape'], np.array(matrix.shape, dtype=np.int64))
+    np.save(paths['norms'], l1_row_norms(matrix))
+    compile_relatedness_vocab(lang)
+    return paths
+
+
+def compile_relatedness_vocab(lang):
+    """
+    Writes the row and column terms of a relatedness model as memory-mappable `Vocabulary` arrays. When both files list
+     the same terms (as for Finnish) only the rows are written, and `load_relatedness_vocab` shares them.
+    """
+    from .vocabulary import Vocabulary, same_file
+
+    paths = relatedness_paths(lang)
+    rows = Vocabulary.from_file(paths['rows'])
+    rows.save(paths['rows_vocab'])
+    if same_file(paths['rows'], paths['cols']):
+        for path in Vocabulary.files(paths['cols_vocab']):  # written by an earlier compilation of different terms
+            if os.path.isfile(path):
+                os.remove(path)
+    else:
+        Vocabulary.from_file(paths['cols']).save(paths['cols_vocab'])
+
+
+def read_relatedness_vocab(lang):
+    """
+    The row and column `Vocabulary` of a relatedness model read from its term files. The same object is returned twice
+     when both files list the same terms.
+    """
+    from .vocabulary import Vocabulary, same_file
+
+    paths = relatedness_paths(lang)
+    rows = Vocabulary.from_file(paths['rows'])
+    return rows, rows if same_file(paths['rows'], paths['cols']) else Vocabulary.from_file(paths['cols'])
+
+
+def load_relatedness_vocab(lang, mmap_mode='r'):
+    """
+    The row and column `Vocabulary` of a relatedness model opened from the arrays written by `compile_relatedness`, or
+     read from the term files for models compiled without them. Rows and columns of the same terms share one object.
+    """
+    from .vocabulary import Vocabulary
+
+    paths = relatedness_paths(lang)
+    if not Vocabulary.exists(paths['rows_vocab']):
+        return read_relatedness_vocab(lang)
+    rows = Vocabulary.load(paths['rows_vocab'], mmap_mode=mmap_mode)
+    if Vocabulary.exists(paths['cols_vocab']):
+        return rows, Vocabulary.load(paths['cols_vocab'], mmap_mode=mmap_mode)
+    return rows, rows
+
+
+def load_relatedness(lang, mmap_mode='r'):
+    """
+    Opens the compiled relatedness matrix of a language as a CSR matrix backed by the memory-mapped arrays.
+    """
+    from scipy import sparse
+
+    if not is_relatedness_compiled(lang):
+        raise Exception("Compiled relatedness model for language '{}' was not found! "
+                        "Compile it using `python -m semeval.convert -m {} -l {}`"
+                        .format(lang, 'relatedness', lang))
+
+    paths = relatedness_paths(lang)
+    arrays = [np.load(paths[k], mmap_mode=mmap_mode) for k in ['data', 'indices', 'indptr']]
+    shape = tuple(int(x) for x in np.load(paths['shape']))
+    return sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+
+def quantized_paths(lang, method):
+    """
+    Paths of the codes of the quantized vectors, which can be memory-mapped, and of the parameters needed to decode them.
+    """
+    base = "{}vectors-{}.{}".format(download_path(), lang, method)
+    return {'codes': base + ".npy", 'params': base + ".npz", 'vocab': embeddings_paths(lang)['vocab']}
+
+
+def compile_quantized(lang, method='int8', **kwargs):
+    """
+    Quantizes the compiled vectors of a language (compiling them first if needed) as 'float16', 'int8' or 'pq' codes,
+     which `Embeddings(lang, quantization=method)` opens.
+
+    :param kwargs: options of the quantizer, see `semeval.quantize`
+    """
+    from .quantize import QuantizedVectors
+
+    if not is_compiled(lang):
+        compile_embeddings(lang)
+    _, vectors, _ = load_embeddings(lang, mmap_mode='r')
+    paths = quantized_paths(lang, method)
+    QuantizedVectors.build(vectors, method, **kwargs).save(paths['codes'], paths['params'])
+    return paths
+
+
+def load_quantized(lang, method, mmap_mode='r', max_vocab=None, vocab=None):
+    """
+    Opens the quantized vectors of a language and returns the vocabulary and the `QuantizedVectors`, restricted to the
+     rows selected by `select_rows`.
+    """
+    from .quantize import QuantizedVectors
+
+    paths = quantized_paths(lang, method)
+    if not all(os.path.isfile(paths[k]) for k in ['codes', 'params', 'vocab']):
+        raise Exception("Quantized vectors '{}' for language '{}' were not found! "
+                        "Compile them using `python -m semeval.convert -m {} -l {}`"
+                        .format(method, lang, method, lang))
+
+    with io.open(paths['vocab'], 'r', encoding='utf-8', newline='\n') as f:
+        content = f.read()
+    words = content.split('\n') if content else []
+    quantized = QuantizedVectors.load(paths['codes'], paths['params'], mmap_mode=mmap_mode)
+    if max_vocab or vocab is not None:
+        words, rows = select_rows(words, max_vocab, vocab)
+        quantized = quantized.subset(rows)
+    return words, quantized
+
+
+def build_index(lang, mmap=False, max_vocab=None, vocab=None, **kwargs):
+    """
+    Builds the approximate nearest neighbour index of a language and saves it next to the vectors.
+    """
+    from .embeddings import Embeddings
+    return Embeddings(lang, mmap=mmap, max_vocab=max_vocab, vocab=vocab).ann_index(rebuild=True, **kwargs)
+
+
+def read_vocab(path):
+    """
+    Reads an allow-list of words, one per line.
+    """
+    with io.open(path, 'r', encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def main(languages, models, max_vocab=None, vocab=None):
+    for language in languages:
+        for model in models:
+            if model == 'embeddings':
+                print("Compiling", model, "for", language)
+                compile_embeddings(language, max_vocab=max_vocab, vocab=vocab)
+            elif model == 'relatedness':
+                print("Compiling", model, "for", language)
+                compile_relatedness(language)
+            elif model in ['float16', 'int8', 'pq']:
+                print("Quantizing embeddings as", model, "for", language)
+                compile_quantized(language, model)
+            elif model == 'index':
+                print("Building", model, "for", language)
+                build_index(language, mmap=is_compiled(language), max_vocab=max_vocab, vocab=vocab)
+            else:
+                raise (BaseException("Unknown model type " + model))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='semeval convert downloaded models into fast-loading formats')
+    parser.add_argument('-l', '--languages', nargs='+', help='<Required> languages to convert', required=True)
+    parser.add_argument('-m', '--models', nargs='+', help='<Required> models to convert', required=True)
+    parser.add_argument('--max-vocab', type=int, default=None,
+                        help='compile only the most frequent words of the embeddings')
+    parser.add_argument('--vocab', default=None, help='compile only the words of this file, one per line')
+    args = parser.parse_args()
+
+    main(args.languages, args.models, args.max_vocab, read_vocab(args.vocab) if args.vocab else None)
@@ -1,8 +1,31 @@
 import argparse
+import hashlib
+import shutil
+import time
+import threading
+import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from .common import *
 
 ZENODO_BASEURL = "https://zenodo.org/record/5156189/files/"
 
+RELATEDNESS_MODELS = {
+    'eng': {
+        'rows': 'https://zenodo.org/record/4633293/files/rows.txt',
+        'cols': 'https://zenodo.org/record/4633293/files/cols.txt',
+        'model': 'https://zenodo.org/record/4633293/files/model_gzip.hkl'
+    },
+    'fin': {
+        'rows': 'https://zenodo.org/record/3473456/files/unigrams_sorted_5k.txt',
+        'cols': 'https://zenodo.org/record/3473456/files/unigrams_sorted_5k.txt',
+        'model': 'https://zenodo.org/record/3473456/files/rel_matrix_n_csr.hkl'
+    }
+}
+
+# size of the blocks written to disk while downloading
+CHUNK_SIZE = 1024 * 1024
+
 
 def _file_name(lang, model):
     if model == "sentiment":
@@ -15,46 +38,196 @@ def _file_name(lang, model):
         raise (BaseException("Unknown model type " + model))
 
 
+def model_files(language, model, base_url=ZENODO_BASEURL):
+    """
+    The URLs of the files of a model of a language and the paths they are downloaded to.
+    """
+    if model == 'relatedness':
+        if language not in RELATEDNESS_MODELS:
+            raise (BaseException("Language not supported!"))
+        return [("{}?download=1".format(_link),
+                 "{}{}-relatedness-{}.{}".format(download_path(), language, _f_name, _link.split('.')[-1]))
+                for _f_name, _link in RELATEDNESS_MODELS[language].items()]
+    file = _file_name(language, model)
+    return [(base_url + file + "?download=1", download_path() + file)]
+
+
+def file_checksum(path, algorithm='md5'):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def verify(path, checksum):
+    """
+    Checks a file against a checksum written as `algorithm:hexdigest` (e.g. 'md5:...', as listed by Zenodo).
+    """
+    algorithm, _, digest = checksum.partition(':')
+    return file_checksum(path, algorithm) == digest.lower()
+
+
+def read_checksums(path):
+    """
+    Reads the checksums of files in the format of `md5sum` or `sha256sum` (`hexdigest  file name` lines). Returns a
+     dict of file name: 'algorithm:hexdigest'.
+    """
+    checksums = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            digest, name = line.split(None, 1)
+            algorithm = {32: 'md5', 40: 'sha1', 64: 'sha256'}[len(digest)]
+            checksums[os.path.basename(name.strip().lstrip('*'))] = algorithm + ':' + digest.lower()
+    return checksums
+
+
+def _total_size(response, offset):
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range and not content_range.endswith('/*'):
+        return int(content_range.rsplit('/', 1)[1])
+    length = response.headers.get('Content-Length')
+    return offset + int(length) if length is not None else None
+
+
+def fetch(url, path, checksum=None, session=None, retries=3, chunk_size=CHUNK_SIZE):
+    """
+    Downloads a file into `path + '.part'` and renames it to `path` once it is complete. An interrupted download is
+     resumed with an HTTP Range request, from where it stopped, on the next attempt or the next call. The size of the
+     file is checked against the size announced by the server and, if given, its checksum ('algorithm:hexdigest').
+    """
+    session = session if session is not None else requests.Session()
+    part = path + '.part'
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code == 416:  # nothing left to download
+                    total = _total_size(response, offset)
+                else:
+                    response.raise_for_status()
+                    if response.status_code != 206:  # the server ignored the range, start from the beginning
+                        offset = 0
+                    total = _total_size(response, offset)
+                    with open(part, 'ab' if offset else 'wb') as f:
+                        for block in response.iter_content(chunk_size):
+                            f.write(block)
+            size = os.path.getsize(part)
+            if total is not None and size != total:
+                raise IOError("Downloaded {} of {} bytes of {}".format(size, total, url))
+            break
+        except (requests.RequestException, IOError) as e:
+            if attempt == retries:
+                raise
+            time.sleep(min(30, 2 ** attempt))
+
+    if checksum and not verify(part, checksum):
+        os.remove(part)  # corrupted, the next attempt starts over
+        raise Exception("Checksum of {} does not match {}".format(url, checksum))
+    os.replace(part, path)
+    return path
+
+
 def download_relatedness_model(language):
-    relatedness_models = {
-        'eng': {
-            'rows': 'https://zenodo.org/record/4633293/files/rows.txt',
-            'cols': 'https://zenodo.org/record/4633293/files/cols.txt',
-            'model': 'https://zenodo.org/record/4633293/files/model_gzip.hkl'
-        },
-        'fin': {
-            'rows': 'https://zenodo.org/record/3473456/files/unigrams_sorted_5k.txt',
-            'cols': 'https://zenodo.org/record/3473456/files/unigrams_sorted_5k.txt',
-            'model': 'https://zenodo.org/record/3473456/files/rel_matrix_n_csr.hkl'
-        }
-    }
-    if language not in relatedness_models:
-        raise (BaseException("Language not supported!"))
-
-    for _f_name, _link in relatedness_models[language].items():
-        _ext = _link.split('.')[-1]
-        download_file("{}?download=1".format(_link),
-                      "{}{}-relatedness-{}.{}".format(download_path(), language, _f_name, _ext),
-                      show_progress=True)
-
-
-def main(languages, models):
-    os.makedirs(script_path("data"), exist_ok=True)
-    for language in languages:
-        for model in models:
-            if model == 'relatedness':
-                download_relatedness_model(language)
+    main([language], ['relatedness'], workers=1)
+
+
+def _convert(language, model):
+    from . import convert
+    if model == 'embeddings':
+        convert.compile_embeddings(language)
+    elif model == 'relatedness':
+        convert.compile_relatedness(language)
+
+
+def main(languages, models, workers=4, convert=False, checksums=None, force=False, retries=3,
+         base_url=ZENODO_BASEURL):
+    """
+    Downloads the models of the languages concurrently with `workers` threads. Files that are already downloaded (and
+     match their checksum) are skipped unless `force`, and interrupted downloads are resumed. A URL listed for several
+     files (e.g. the rows and cols of fin) is downloaded once and copied.
+
+    :param convert: compile every model into its fast-loading format (see `semeval.convert`) as soon as its files are
+     downloaded
+    :param checksums: dict of file name: 'algorithm:hexdigest' the downloaded files are verified against
+    """
+    os.makedirs(download_path(), exist_ok=True)
+    checksums = checksums or {}
+    groups = {(language, model): model_files(language, model, base_url) for language in languages for model in models}
+    remaining = {key: len(set(p for _, p in files)) for key, files in groups.items()}
+    targets = {}  # url: [(key, path), ...]
+    for key, files in groups.items():
+        for url, path in files:
+            if (key, path) not in targets.setdefault(url, []):
+                targets[url].append((key, path))
+    lock = threading.Lock()
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=workers))
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=workers))
+
+    def needed(path):
+        checksum = checksums.get(os.path.basename(path))
+        return force or not os.path.isfile(path) or (checksum and not verify(path, checksum))
+
+    def download(url, files):
+        """
+        Downloads a URL to the first of its files that is needed and copies it to the others. Returns the models whose
+         files are then all downloaded.
+        """
+        missing = [(key, path) for key, path in files if needed(path)]
+        present = [path for key, path in files if (key, path) not in missing]
+        source = present[0] if present else None
+        for key, path in missing:
+            if source is None:
+                print("Downloading", os.path.basename(path), "for", key[0])
+                fetch(url, path, checksum=checksums.get(os.path.basename(path)), session=session, retries=retries)
+                source = path
             else:
-                file = _file_name(language, model)
-                print("Downloading", model, "for", language)
-                download_file(ZENODO_BASEURL + file + "?download=1", download_path() + file,
-                              show_progress=True)
+                shutil.copyfile(source, path + '.part')
+                os.replace(path + '.part', path)
+        with lock:
+            for key, _ in files:
+                remaining[key] -= 1
+            return [key for key in OrderedDict.fromkeys(key for key, _ in files) if remaining[key] == 0]
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download, url, files): ('download', files[0][0]) for url, files in targets.items()}
+        while futures:
+            for future in as_completed(list(futures)):
+                step, key = futures.pop(future)
+                try:
+                    complete = future.result()
+                except Exception as e:
+                    errors.append("{} {} for {}: {}".format(step, key[1], key[0], e))
+                    continue
+                if step == 'download' and convert:
+                    for key in complete:
+                        if key[1] in ['embeddings', 'relatedness']:
+                            print("Compiling", key[1], "for", key[0])
+                            futures[executor.submit(_convert, *key)] = ('convert', key)
+                break
+
+    if errors:
+        raise Exception("Failed to " + "; ".join(errors))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='semeval download models')
     parser.add_argument('-l', '--languages', nargs='+', help='<Required> languages to download', required=True)
     parser.add_argument('-m', '--models', nargs='+', help='<Required> models to download', required=True)
+    parser.add_argument('-w', '--workers', type=int, default=4, help='number of concurrent downloads (default: 4)')
+    parser.add_argument('--convert', action='store_true',
+                        help='compile each model into its fast-loading format once downloaded (see semeval.convert)')
+    parser.add_argument('--checksums', default=None,
+                        help='file of md5sum or sha256sum lines the downloaded files are verified against')
+    parser.add_argument('--force', action='store_true', help='download the files again even if they exist')
+    parser.add_argument('--retries', type=int, default=3, help='attempts to resume a failed download (default: 3)')
     args = parser.parse_args()
 
-    main(args.languages, args.models)
+    main(args.languages, args.models, workers=args.workers, convert=args.convert,
+         checksums=read_checksums(args.checksums) if args.checksums else None, force=args.force,
+         retries=args.retries)
@@ -1,60 +1,521 @@
 from gensim.models import KeyedVectors
+from gensim.models.keyedvectors import Vocab
 import numpy as np
+import io
+import operator
+from collections.abc import Mapping, Sequence
 from pathlib import Path
 from .common import *
+from . import convert
+from .index import IVFIndex
+
+# upper bound of the number of similarity scores held in memory at once by the batch methods
+MAX_CHUNK_ELEMENTS = 2 ** 25
+
+
+def top_k(scores, k):
+    """
+    Indices of the `k` highest scores of every row of `scores`, best first, selected with `argpartition`.
+    """
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        best = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1)
+    return np.take_along_axis(best, order, axis=1)
+
+
+def mean_top(scores, k):
+    """
+    Mean of the `k` highest scores of every row of `scores`.
+    """
+    k = min(k, scores.shape[1])
+    return -np.partition(-scores, k - 1, axis=1)[:, :k].mean(axis=1)
+
+
+def _score_chunks(queries, normed, indices, chunk_size):
+    """
+    Yields the position of every chunk of `chunk_size` indices and the similarities of the rows of `queries` at these
+     indices to all rows of `normed`. Only one chunk of rows is copied at a time, also from memory-mapped matrices.
+    """
+    for start in range(0, len(indices), chunk_size):
+        yield start, np.dot(queries[indices[start:start + chunk_size]], normed.T)
+
+
+class VocabDict(Mapping):
+    """
+    gensim's dict of word: `Vocab` on top of a `Vocabulary`; the `Vocab` of a word is created when it is looked up.
+    """
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+
+    def __getitem__(self, word):
+        index = self.vocabulary[word]
+        return Vocab(index=index, count=len(self.vocabulary) - index)
+
+    def __contains__(self, word):
+        return word in self.vocabulary
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def __iter__(self):
+        return iter(self.vocabulary)
+
+
+class WordList(Sequence):
+    """
+    gensim's `index2word` list on top of a `Vocabulary`; the words are decoded when they are read.
+    """
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.vocabulary.terms(np.arange(len(self))[index])
+        index = operator.index(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("word index out of range")
+        return self.vocabulary.term(index)
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def __iter__(self):
+        return iter(self.vocabulary)
+
+
+def keyed_vectors(words, vectors, vectors_norm=None, vector_size=None):
+    """
+    Wraps existing arrays (e.g. memory-mapped or shared ones) into gensim's KeyedVectors without copying them.
+
+    :param words: a list, which is indexed into gensim's dict with one `Vocab` object per word, or a `Vocabulary`
+     (e.g. memory-mapped), which is used as is so that no per-word work is done
+    """
+    if isinstance(words, WordList):
+        words = words.vocabulary
+    kv = KeyedVectors(vectors.shape[1] if vectors is not None else vector_size)
+    kv.vectors = vectors
+    kv.vectors_norm = vectors_norm
+    if isinstance(words, list):
+        kv.index2word = words
+        kv.vocab = {w: Vocab(index=i, count=len(words) - i) for i, w in enumerate(words)}
+    else:
+        kv.index2word = WordList(words)
+        kv.vocab = VocabDict(words)
+    return kv
 
 
 class Embeddings(object):
-    def __init__(self, lang='eng'):
+    def __init__(self, lang='eng', mmap=False, quantization=None, max_vocab=None, vocab=None):
+        """
+        :param mmap: open the compiled `.npy` files (see `python -m semeval.convert`) read-only with `mmap_mode='r'`
+         instead of parsing the text vectors. Processes on the same host then share the pages of the OS page cache.
+         The words are looked up in the memory-mapped `Vocabulary` arrays, so opening does no per-word work; models
+         compiled without them read the word list and build gensim's dict, which takes time linear in the vocabulary.
+        :param quantization: open the vectors compiled as 'float16', 'int8' or 'pq' codes (see
+         `python -m semeval.convert -m float16`) instead of the float32 vectors. Similarities are then approximate.
+        :param max_vocab: load only the first (most frequent) words; the text vectors are parsed up to them and the
+         compiled vectors are sliced without copying
+        :param vocab: load only the words of this allow-list. The text vectors are streamed and only the selected rows
+         are parsed; a pruned model compiled with `python -m semeval.convert --max-vocab N --vocab FILE` is opened
+         directly with `mmap=True`.
+        """
         model_path = Path(download_path() + "vectors-{}.txt".format(lang))
         if lang not in supported_languages():
             raise Exception("Language '{}' is not supported!".format(lang))
+        elif quantization:
+            words, quantized = convert.load_quantized(lang, quantization, mmap_mode='r' if mmap else None,
+                                                      max_vocab=max_vocab, vocab=vocab)
+            self._set_model(lang, keyed_vectors(words, None, vector_size=quantized.dim), quantized)
+            return
+        elif mmap:
+            words, vectors, vectors_norm = convert.load_embeddings(lang, mmap_mode='r', max_vocab=max_vocab,
+                                                                   vocab=vocab)
+            L = keyed_vectors(words, vectors, vectors_norm)
         elif not model_path.is_file():
             raise Exception("Vectors for language '{}' are not downloaded! "
                             "Download them using `python -m semeval.download -m {} -l {}`"
                             .format(lang, 'embeddings', lang))
+        elif vocab is not None:
+            words, vectors = convert.read_embeddings(lang, max_vocab=max_vocab, vocab=vocab)
+            L = keyed_vectors(words, vectors)
+        else:
+            L = KeyedVectors.load_word2vec_format(model_path, binary=False, unicode_errors='replace', limit=max_vocab)
+        self._set_model(lang, L)
+        self.index_path = convert.embeddings_paths(lang, max_vocab, vocab)['index']
+
+    @classmethod
+    def from_vectors(cls, lang, words, vectors, vectors_norm=None):
+        """
+        Creates embeddings on top of already loaded arrays (e.g. attached from shared memory) without copying them.
+         `words` is a list or a `Vocabulary`, see `keyed_vectors`.
+        """
+        e = cls.__new__(cls)
+        e._set_model(lang, keyed_vectors(words, vectors, vectors_norm))
+        return e
 
-        self.L = KeyedVectors.load_word2vec_format(model_path, binary=False, unicode_errors='replace')
+    def quantize(self, method='int8', **kwargs):
+        """
+        A copy of the embeddings storing only the 'float16', 'int8' or 'pq' codes of the vectors (see
+         `semeval.quantize`), searched without decoding the whole matrix. `python -m semeval.quantize` reports how far
+         the results drift.
+        """
+        from .quantize import QuantizedVectors
+        if self.quantized is not None:
+            raise Exception("The embeddings are already quantized, quantize the float vectors")
+        e = self.__class__.__new__(self.__class__)
+        e._set_model(self.lang, keyed_vectors(self.L.index2word, None, vector_size=self.L.vector_size),
+                     QuantizedVectors.build(self.L.vectors, method, **kwargs))
+        return e
+
+    def _set_model(self, lang, L, quantized=None):
+        self.lang = lang
+        self.L = L
         self.L_len = len(self.L.vocab)
+        self.quantized = quantized
+        self.index_path = convert.embeddings_paths(lang)['index']
+        self._ann_index = None
+
+    def ann_index(self, rebuild=False, **kwargs):
+        """
+        The approximate nearest neighbour index used by the `approximate=True` searches. It is loaded from next to the
+         model files, or built and saved there the first time (see `python -m semeval.convert -m index`).
+
+        :param kwargs: options of `IVFIndex.build`, e.g. `n_lists` and `n_probe`
+        """
+        if self._ann_index is None or rebuild:
+            path = self.index_path
+            index = IVFIndex.load(path) if os.path.isfile(path) and not rebuild else None
+            if index is None or len(index.members) != self.L_len:  # missing, or built for another vocabulary
+                index = IVFIndex.build(self._normed(), **kwargs)
+                index.save(path)
+            self._ann_index = index
+        return self._ann_index
+
+    def index_recall(self, topn=10, n_probe=None, sample=1000, seed=0):
+        """
+        Recall@topn of the approximate neighbours of `sample` random words against the exact search.
+        """
+        queries = np.random.RandomState(seed).choice(self.L_len, min(sample, self.L_len), replace=False)
+        return self.ann_index().recall(self._normed(), queries, topn=topn, n_probe=n_probe)
+
+    def _approximate(self, query, topn, exclude=(), n_probe=None):
+        query = query / np.linalg.norm(query)
+        indices, scores = self.ann_index().search(self._normed(), query.astype(np.float32), topn=topn,
+                                                  n_probe=n_probe, exclude=exclude)
+        return [(self.L.index2word[i], float(s)) for i, s in zip(indices, scores)]
+
+    def _query(self, positive, negative=()):
+        """
+        The vocabulary indices of the words of a query, the normalized vectors of its positive and negative terms and
+         their unit-length mean. As in gensim, the terms can be words or vectors.
+        """
+        words = [self._indices([w])[0] for w in list(positive) + list(negative) if isinstance(w, str)]
+        pos = [self._unit(self._indices([w]))[0] if isinstance(w, str) else w for w in positive]
+        neg = [self._unit(self._indices([w]))[0] if isinstance(w, str) else w for w in negative]
+        mean = np.mean(pos + [-v for v in neg], axis=0)
+        return words, pos, neg, mean / np.linalg.norm(mean)
 
     @staticmethod
-    def align(e1, e2, word, topn=10):
-        return e2.L.similar_by_vector(e1.L.word_vec(word), topn=topn)
+    def align(e1, e2, word, topn=10, approximate=False, n_probe=None):
+        if approximate:
+            return e2._approximate(e1.vector(word), topn, n_probe=n_probe)
+        if e2.quantized is not None:
+            query = e1.vector(word)
+            return e2._search((query / np.linalg.norm(query))[np.newaxis, :], [[]], topn)[0]
+        return e2.L.similar_by_vector(e1.vector(word), topn=topn)
 
     def vector(self, word):
+        if self.quantized is not None:
+            return self.vectors([word])[0]
         return self.L[word]
 
-    def project(self, word, e2, topn=10):
-        return self.align(self, e2, word, topn=topn)
+    def project_all(self, e2, words=None, topn=10, chunk_size=None, output=None, csls=False, csls_k=10,
+                    mutual=False):
+        """
+        `project` for many words (default: the whole vocabulary), `chunk_size` words at a time with one product of the
+         normalized matrices of both models per chunk. Memory is bounded by a chunk of scores whatever the sizes of the
+         vocabularies.
+
+        :param output: path of a TSV file the (word, translation, score) lines are written to chunk by chunk, instead of
+         returning a dict of word: [(translation, score), ...]
+        :param csls: rank the translations by cross-domain similarity local scaling (Conneau et al., 2018) instead of
+         cosine similarity, which demotes hubs close to many words. Costs one pass over the vocabulary of `e2`.
+        :param csls_k: number of neighbours over which CSLS measures the density around a word
+        :param mutual: keep only the translations whose nearest neighbour in this model is the word itself. Costs one
+         pass over the vocabulary of `e2` (and one over this vocabulary with `csls`).
+        """
+        source, target = self._normed(), e2._normed()
+        chunk_size = chunk_size if chunk_size else max(1, MAX_CHUNK_ELEMENTS // max(1, len(target)))
+        reverse_chunk_size = max(1, MAX_CHUNK_ELEMENTS // max(1, len(source)))
+        indices = np.arange(self.L_len) if words is None else self._indices(list(words))
+        all_source, all_target = np.arange(len(source)), np.arange(len(target))
+
+        r_source = r_target = None  # density of the neighbourhoods of the target words in the source and vice versa
+        if csls:
+            r_source = np.empty(len(target), dtype=np.float32)
+            for start, scores in _score_chunks(target, source, all_target, reverse_chunk_size):
+                r_source[start:start + len(scores)] = mean_top(scores, csls_k)
+        best_source = None
+        if mutual:
+            if csls:
+                r_target = np.empty(len(source), dtype=np.float32)
+                for start, scores in _score_chunks(source, target, all_source, chunk_size):
+                    r_target[start:start + len(scores)] = mean_top(scores, csls_k)
+            best_source = np.empty(len(target), dtype=np.int64)
+            for start, scores in _score_chunks(target, source, all_target, reverse_chunk_size):
+                if csls:  # the density around the target word is the same for every source word
+                    scores = 2 * scores - r_target[np.newaxis, :]
+                best_source[start:start + len(scores)] = np.argmax(scores, axis=1)
+
+        results = {}
+        f = io.open(output, 'w', encoding='utf-8', newline='\n') if output else None
+        try:
+            for start, scores in _score_chunks(source, target, indices, chunk_size):
+                if csls:
+                    density = mean_top(scores, csls_k)
+                    scores *= 2
+                    scores -= density[:, np.newaxis]
+                    scores -= r_source[np.newaxis, :]
+                for r, best in enumerate(top_k(scores, topn)):
+                    i = indices[start + r]
+                    if mutual:
+                        best = best[best_source[best] == i]
+                    word = self.L.index2word[i]
+                    translations = [(e2.L.index2word[j], float(scores[r, j])) for j in best]
+                    if f is None:
+                        results[word] = translations
+                    else:
+                        f.write(''.join("{}\t{}\t{}\n".format(word, t, s) for t, s in translations))
+        finally:
+            if f is not None:
+                f.close()
+        return output if output else results
+
+    def project(self, word, e2, topn=10, approximate=False, n_probe=None):
+        return self.align(self, e2, word, topn=topn, approximate=approximate, n_probe=n_probe)
 
     def similarity(self, *args, **kwargs):
-        return self.L.similarity(*args, **kwargs)
+        if self.quantized is not None:
+            return self.similarity_batch([args])[0]
+        t = timer('embeddings.similarity')
+        result = self.L.similarity(*args, **kwargs)
+        t.mark('compute')
+        return result
+
+    def n_similarity(self, ws1, ws2):
+        """
+        Cosine similarity of the means of the vectors of two lists of words, as gensim's `n_similarity`.
+        """
+        if self.quantized is None:
+            return self.L.n_similarity(ws1, ws2)
+        if not (len(ws1) and len(ws2)):
+            raise ZeroDivisionError('At least one of the passed list is empty.')
+        v1, v2 = self.vectors(ws1).mean(axis=0), self.vectors(ws2).mean(axis=0)
+        return np.dot(v1 / np.linalg.norm(v1), v2 / np.linalg.norm(v2))
+
+    def most_similar(self, positive=None, negative=None, topn=10, approximate=False, n_probe=None):
+        t = timer('embeddings.most_similar')
+        if not approximate and self.quantized is None:
+            result = self.L.most_similar_cosmul(positive=positive, negative=negative, topn=topn)
+            t.mark('compute')
+            return result
 
-    def most_similar(self, *args, **kwargs):
-        return self.L.most_similar_cosmul(*args, **kwargs)
+        # candidates come from the index, or are all words of quantized embeddings; they are then ranked by the
+        # multiplicative objective as in gensim
+        positive = [positive] if isinstance(positive, str) else list(positive or [])
+        words, pos, neg, query = self._query(positive, list(negative or []))
+        candidates = np.sort(self.ann_index().candidates(query, n_probe)) if approximate else np.arange(self.L_len)
+        candidates = candidates[~np.isin(candidates, words)]
+        t.mark('lookup')
+        similarities = (1 + self._dot(np.array(pos + neg, dtype=np.float32), candidates)) / 2
+        scores = np.prod(similarities[:len(pos)], axis=0) / (np.prod(similarities[len(pos):], axis=0) + 0.000001)
+        best = top_k(scores[np.newaxis, :], topn)[0]
+        t.mark('compute')
+        result = [(self.L.index2word[candidates[i]], float(scores[i])) for i in best]
+        t.mark('serialize')
+        return result
 
-    def theme(self, l):
+    def theme(self, l, approximate=False, n_probe=None):
+        if approximate:
+            words, _, _, query = self._query(l)
+            return self._approximate(query, 1, exclude=words, n_probe=n_probe)[0]
+        if self.quantized is not None:
+            words, _, _, query = self._query(l)
+            return self._search(query[np.newaxis, :], [words], 1)[0][0]
         return self.L.most_similar(positive=l, topn=1)[0]
 
     def vocabulary(self):
         return self.L.vocab
 
     def centroid(self, l):
+        if self.quantized is not None:
+            return np.mean(self.vectors([w for w in l if w in self.L.vocab]), axis=0)
         vectors = [self.L.get_vector(w) for w in l if w in self.L.vocab]
         return np.mean(vectors, axis=0)
 
-    def neighbours(self, w, topn=50):
-        return self.L.most_similar(w, topn=topn)
+    def neighbours(self, w, topn=50, approximate=False, n_probe=None):
+        if approximate:
+            words, _, _, query = self._query([w])
+            return self._approximate(query, topn, exclude=words, n_probe=n_probe)
+        if self.quantized is not None:
+            return self.neighbours_batch([w], topn=topn)[0]
+        t = timer('embeddings.neighbours')
+        result = self.L.most_similar(w, topn=topn)
+        t.mark('compute')
+        return result
 
-    def neighbours_threshold(self, w, threshold=0.8):
-        return [x for x in self.L.most_similar(w, topn=self.L_len) if x[1] >= threshold]
+    def neighbours_threshold(self, w, threshold=0.8, approximate=False, n_probe=None, max_results=None):
+        """
+        Neighbours of `w` with a similarity of at least `threshold`, best first. Only the words passing the threshold
+         are sorted, and at most `max_results` of them are returned if it is given.
+        """
+        t = timer('embeddings.neighbours_threshold')
+        words, _, _, query = self._query([w])
+        candidates = np.sort(self.ann_index().candidates(query, n_probe)) if approximate else None
+        t.mark('lookup')
+        scores = self._dot(query[np.newaxis, :], candidates)[0]
+
+        hits = np.flatnonzero(scores >= threshold)
+        indices = candidates[hits] if candidates is not None else hits
+        keep = ~np.isin(indices, words)
+        hits, indices = hits[keep], indices[keep]
+        if max_results is not None and max_results < len(hits):
+            best = np.argpartition(-scores[hits], max_results - 1)[:max_results] if max_results > 0 else []
+            hits, indices = hits[best], indices[best]
+        order = np.argsort(-scores[hits], kind='stable')
+        t.mark('compute')
+        result = [(self.L.index2word[i], float(s)) for i, s in zip(indices[order], scores[hits][order])]
+        t.mark('serialize')
+        return result
 
     def analogy(self, a, b, c, topn=10):
-        return list(self.L.most_similar(positive=[b, c], negative=[a], topn=topn))
+        if self.quantized is not None:
+            return self.analogy_batch([(a, b, c)], topn=topn)[0]
+        t = timer('embeddings.analogy')
+        result = list(self.L.most_similar(positive=[b, c], negative=[a], topn=topn))
+        t.mark('compute')
+        return result
 
     def to_vector(self, tokens):
-        text_v = [self.L.get_vector(t) for t in tokens if t in self.L.vocab]
+        t = timer('embeddings.to_vector')
+        if self.quantized is not None:
+            text_v = list(self.vectors([w for w in tokens if w in self.L.vocab]))
+        else:
+            text_v = [self.L.get_vector(w) for w in tokens if w in self.L.vocab]
+        t.mark('lookup')
 
         if len(text_v) == 0:
             raise Exception("No words in the text found in the model.")
-        return np.mean(text_v, axis=0)
+        result = np.mean(text_v, axis=0)
+        t.mark('compute')
+        return result
+
+    def to_vectors(self, documents, output=None, batch_size=10000, empty='zeros', processes=None):
+        """
+        `to_vector` for a stream of documents, see `semeval.vectorize.vectorize`.
+        """
+        from .vectorize import vectorize
+        return vectorize(self, documents, output=output, batch_size=batch_size, empty=empty, processes=processes)
+
+    def _indices(self, words):
+        indices = np.empty(len(words), dtype=np.int64)
+        for i, w in enumerate(words):
+            if w not in self.L.vocab:
+                raise KeyError("word '{}' not in vocabulary".format(w))
+            indices[i] = self.L.vocab[w].index
+        return indices
+
+    def _normed(self):
+        if self.quantized is not None:
+            raise Exception("The embeddings are quantized, this operation needs the float vectors")
+        self.L.init_sims()
+        return self.L.vectors_norm
+
+    def _unit(self, indices):
+        """
+        The unit-length vectors of the words at the given indices.
+        """
+        if self.quantized is not None:
+            return self.quantized.unit(indices)
+        return self._normed()[indices]
+
+    def _dot(self, queries, rows=None):
+        """
+        Cosine similarities of the unit-length `queries` with the words (at the indices `rows`), queries x words.
+        """
+        if self.quantized is not None:
+            return self.quantized.dot(queries, rows)
+        normed = self._normed()
+        return np.dot(queries, (normed[rows] if rows is not None else normed).T)
+
+    def _chunk_size(self, chunk_size=None):
+        return chunk_size if chunk_size else max(1, MAX_CHUNK_ELEMENTS // max(1, self.L_len))
+
+    def _search(self, queries, exclude, topn, chunk_size=None):
+        """
+        Scores the unit-length `queries` against the whole normalized vocabulary, `chunk_size` queries at a time, and
+         returns the `topn` best (word, score) pairs of every query. `exclude` lists the indices to skip per query.
+        """
+        t = timer('embeddings.search')
+        chunk_size = self._chunk_size(chunk_size)
+        results = []
+        for start in range(0, len(queries), chunk_size):
+            scores = self._dot(queries[start:start + chunk_size])
+            for r, ex in enumerate(exclude[start:start + chunk_size]):
+                scores[r, ex] = -np.inf
+            best = top_k(scores, topn)
+            t.mark('compute')
+            for r in range(len(best)):
+                results.append([(self.L.index2word[i], float(scores[r, i])) for i in best[r]
+                                if scores[r, i] != -np.inf])
+            t.mark('serialize')
+        return results
+
+    def vectors(self, words):
+        """
+        The vectors of the given words as a matrix, one row per word.
+        """
+        if self.quantized is not None:
+            return self.quantized.vectors(self._indices(words))
+        return self.L.vectors[self._indices(words)]
+
+    def similarity_batch(self, pairs, chunk_size=None):
+        """
+        Cosine similarities of the given (w1, w2) pairs as an array.
+        """
+        pairs = list(pairs)
+        a = self._indices([p[0] for p in pairs])
+        b = self._indices([p[1] for p in pairs])
+        scores = np.empty(len(pairs), dtype=np.float32)
+        chunk_size = chunk_size if chunk_size else max(1, MAX_CHUNK_ELEMENTS // (2 * self.L.vector_size))
+        for start in range(0, len(pairs), chunk_size):
+            end = start + chunk_size
+            scores[start:end] = np.einsum('ij,ij->i', self._unit(a[start:end]), self._unit(b[start:end]))
+        return scores
+
+    def neighbours_batch(self, words, topn=50, chunk_size=None):
+        """
+        The result of `neighbours(w, topn)` for every word, computed with one matrix multiplication per chunk.
+        """
+        indices = self._indices(list(words))
+        queries = self._unit(indices)
+        return self._search(queries, indices[:, np.newaxis], topn, chunk_size)
+
+    def analogy_batch(self, triples, topn=10, chunk_size=None):
+        """
+        The result of `analogy(a, b, c, topn)` for every (a, b, c) triple.
+        """
+        triples = list(triples)
+        indices = np.stack([self._indices([t[i] for t in triples]) for i in range(3)], axis=1).reshape(-1, 3)
+        queries = (self._unit(indices[:, 1]) + self._unit(indices[:, 2]) - self._unit(indices[:, 0])) / 3
+        queries /= np.linalg.norm(queries, axis=1)[:, np.newaxis]
+        return self._search(queries, indices, topn, chunk_size)
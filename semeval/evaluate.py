@@ -0,0 +1,219 @@
+import argparse
+import io
+import json
+import time
+import numpy as np
+from .common import *
+from .embeddings import Embeddings, MAX_CHUNK_ELEMENTS
+
+ANALOGY_METHODS = ['3CosAdd', '3CosMul']
+
+
+def read_analogies(path):
+    """
+    Reads analogy questions. A file holds questions `a b c d` (a is to b as c is to d), one per line, and lines starting
+     with `:` name the section of the following questions, as in the Google analogy set. A directory is read as BATS:
+     every `.txt` file in it is a section listing `word<TAB>answer1/answer2...` pairs, and every ordered combination of
+     two pairs of a file is a question.
+
+    :return: a list of (section, a, b, c, answers) tuples, where answers lists the accepted words for d
+    """
+    questions = []
+    if os.path.isdir(path):
+        for root, _, files in sorted(os.walk(path)):
+            for name in sorted(files):
+                if not name.endswith('.txt'):
+                    continue
+                with io.open(os.path.join(root, name), 'r', encoding='utf-8') as f:
+                    pairs = [line.strip().split('\t') for line in f if line.strip()]
+                pairs = [(p[0], p[1].split('/')) for p in pairs if len(p) == 2]
+                section = os.path.splitext(name)[0]
+                for a, a_answers in pairs:
+                    for c, c_answers in pairs:
+                        if a != c:
+                            questions.append((section, a, a_answers[0], c, c_answers))
+        return questions
+
+    section = None
+    with io.open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith(':'):
+                section = line[1:].strip()
+                continue
+            words = line.split()
+            if len(words) == 4:
+                questions.append((section, words[0], words[1], words[2], [words[3]]))
+    return questions
+
+
+def read_similarities(path):
+    """
+    Reads word similarity judgements `w1 w2 score`, one per line and separated by tabs or spaces, as in WordSim353 or
+     SimLex-999. Lines whose third field is not a number (headers, comments) are skipped.
+    """
+    pairs = []
+    with io.open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            fields = line.split('\t') if '\t' in line else line.split()
+            if len(fields) < 3:
+                continue
+            try:
+                pairs.append((fields[0].strip(), fields[1].strip(), float(fields[2])))
+            except ValueError:
+                continue
+    return pairs
+
+
+def _index(e, words, restrict_vocab=None):
+    """
+    The vocabulary indices of the words, -1 for the words out of the (restricted) vocabulary.
+    """
+    vocab = e.L.vocab
+    indices = np.array([vocab[w].index if w in vocab else -1 for w in words], dtype=np.int64)
+    if restrict_vocab:
+        indices[indices >= restrict_vocab] = -1
+    return indices
+
+
+def evaluate_analogies(e, questions, methods=ANALOGY_METHODS, restrict_vocab=None, chunk_size=None):
+    """
+    Answers analogy questions by searching the (restricted) vocabulary for the word d maximizing 3CosAdd,
+     cos(d, b) - cos(d, a) + cos(d, c), or 3CosMul (Levy & Goldberg, 2014), the input words excluded. All words are
+     resolved up front and the questions are scored in chunks with one matrix multiplication per term.
+
+    :param questions: (section, a, b, c, answers) tuples, see `read_analogies`
+    :param restrict_vocab: search only the first (most frequent) words of the vocabulary
+    :return: the number of questions, the rate of questions with a word out of the vocabulary, the time taken and, per
+     method, the accuracy over the answerable questions overall and per section
+    """
+    start_time = time.time()
+    normed = e._normed()
+    normed = normed[:restrict_vocab] if restrict_vocab else normed
+    abc = np.stack([_index(e, [q[i] for q in questions], restrict_vocab) for i in (1, 2, 3)], axis=1).reshape(-1, 3)
+    answers = [set(_index(e, q[4], restrict_vocab).tolist()) - {-1} for q in questions]
+    covered = np.flatnonzero((abc >= 0).all(axis=1) & np.array([len(a) > 0 for a in answers], dtype=bool))
+
+    chunk_size = chunk_size if chunk_size else max(1, MAX_CHUNK_ELEMENTS // (3 * max(1, len(normed))))
+    correct = {m: np.zeros(len(questions), dtype=bool) for m in methods}
+    for start in range(0, len(covered), chunk_size):
+        chunk = covered[start:start + chunk_size]
+        a, b, c = (normed[abc[chunk, i]] for i in range(3))
+        rows = np.arange(len(chunk))[:, np.newaxis]
+        for method in methods:
+            if method == '3CosAdd':
+                scores = np.dot(b - a + c, normed.T)
+            elif method == '3CosMul':  # similarities shifted to [0, 1] and epsilon as in gensim's most_similar_cosmul
+                sa, sb, sc = ((1 + np.dot(v, normed.T)) / 2 for v in (a, b, c))
+                scores = sb * sc / (sa + 0.000001)
+            else:
+                raise Exception("Unknown analogy method " + method)
+            scores[rows, abc[chunk]] = -np.inf
+            predicted = np.argmax(scores, axis=1)
+            correct[method][chunk] = [p in answers[q] for p, q in zip(predicted.tolist(), chunk)]
+
+    seconds = time.time() - start_time
+    sections = sorted(set(q[0] for q in questions if q[0] is not None))
+    section_of = np.array([q[0] for q in questions], dtype=object)
+    is_covered = np.zeros(len(questions), dtype=bool)
+    is_covered[covered] = True
+
+    report = {
+        'questions': len(questions),
+        'oov_rate': 1 - len(covered) / float(max(1, len(questions))),
+        'seconds': seconds,
+        'questions_per_second': len(covered) / seconds if seconds > 0 else None,
+    }
+    for method in methods:
+        report[method] = {'accuracy': _accuracy(correct[method], is_covered)}
+        if sections:
+            report[method]['sections'] = {s: _accuracy(correct[method], is_covered & (section_of == s))
+                                          for s in sections}
+    return report
+
+
+def _accuracy(correct, covered):
+    return float(correct[covered].mean()) if covered.any() else None
+
+
+def evaluate_similarity(e, pairs, restrict_vocab=None):
+    """
+    Spearman correlation between the similarity judgements and the cosine similarities of the word pairs in the
+     (restricted) vocabulary.
+
+    :param pairs: (w1, w2, score) tuples, see `read_similarities`
+    """
+    from scipy.stats import spearmanr
+
+    start_time = time.time()
+    w1 = _index(e, [p[0] for p in pairs], restrict_vocab)
+    w2 = _index(e, [p[1] for p in pairs], restrict_vocab)
+    covered = np.flatnonzero((w1 >= 0) & (w2 >= 0))
+    normed = e._normed()
+    predicted = np.einsum('ij,ij->i', normed[w1[covered]], normed[w2[covered]])
+    gold = np.array([pairs[i][2] for i in covered])
+    seconds = time.time() - start_time
+    return {
+        'pairs': len(pairs),
+        'oov_rate': 1 - len(covered) / float(max(1, len(pairs))),
+        'spearman': float(spearmanr(gold, predicted).correlation) if len(covered) > 1 else None,
+        'seconds': seconds,
+        'pairs_per_second': len(covered) / seconds if seconds > 0 else None,
+    }
+
+
+def main(languages, analogies=None, similarities=None, restrict_vocab=None, mmap=False, output=None):
+    """
+    Evaluates the embeddings of every language on the question sets found for it. The paths may contain `{lang}`,
+     which is replaced by the language; languages without a model or a question set are reported and skipped.
+    """
+    results = {}
+    for lang in languages:
+        results[lang] = {}
+        try:
+            e = Embeddings(lang, mmap=mmap)
+        except Exception as ex:
+            results[lang]['error'] = str(ex)
+            print(lang, "skipped:", ex)
+            continue
+
+        for path in analogies or []:
+            path = path.format(lang=lang)
+            if not os.path.exists(path):
+                continue
+            report = evaluate_analogies(e, read_analogies(path), restrict_vocab=restrict_vocab)
+            results[lang].setdefault('analogies', {})[path] = report
+            print(lang, path, "oov: {:.3f}".format(report['oov_rate']),
+                  " ".join("{}: {}".format(m, report[m]['accuracy']) for m in ANALOGY_METHODS),
+                  "({:.0f} questions/s)".format(report['questions_per_second'] or 0))
+
+        for path in similarities or []:
+            path = path.format(lang=lang)
+            if not os.path.exists(path):
+                continue
+            report = evaluate_similarity(e, read_similarities(path), restrict_vocab=restrict_vocab)
+            results[lang].setdefault('similarities', {})[path] = report
+            print(lang, path, "oov: {:.3f}".format(report['oov_rate']), "spearman:", report['spearman'])
+        del e
+
+    if output:
+        with io.open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='semeval evaluate embeddings on analogy and word similarity sets')
+    parser.add_argument('-l', '--languages', nargs='+', default=supported_languages(),
+                        help='languages to evaluate (default: all supported languages)')
+    parser.add_argument('-a', '--analogies', nargs='+', default=[],
+                        help='analogy files (Google format) or directories (BATS format), `{lang}` is replaced by '
+                             'the language')
+    parser.add_argument('-s', '--similarities', nargs='+', default=[],
+                        help='word similarity files, `{lang}` is replaced by the language')
+    parser.add_argument('--restrict-vocab', type=int, default=None,
+                        help='search only the most frequent words of the vocabulary')
+    parser.add_argument('--mmap', action='store_true', help='open the compiled models (see semeval.convert)')
+    parser.add_argument('-o', '--output', default=None, help='JSON file the results are written to')
+    args = parser.parse_args()
+
+    main(args.languages, args.analogies, args.similarities, args.restrict_vocab, args.mmap, args.output)
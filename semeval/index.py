@@ -0,0 +1,113 @@
+import numpy as np
+
+# number of vectors assigned to the centroids at a time
+CHUNK_SIZE = 16384
+
+
+def _assign(vectors, centroids, chunk_size=CHUNK_SIZE):
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        scores = np.dot(np.nan_to_num(vectors[start:start + chunk_size]), centroids.T)
+        labels[start:start + chunk_size] = np.argmax(scores, axis=1)
+    return labels
+
+
+def kmeans(vectors, n_clusters, n_iter=10, seed=0):
+    """
+    Spherical k-means: the centroids are kept at unit length and vectors are assigned by cosine similarity.
+    """
+    rng = np.random.RandomState(seed)
+    centroids = np.nan_to_num(np.array(vectors[rng.choice(len(vectors), n_clusters, replace=False)],
+                                       dtype=np.float32))
+    for _ in range(n_iter):
+        labels = _assign(vectors, centroids)
+        order = np.argsort(labels, kind='stable')
+        counts = np.bincount(labels, minlength=n_clusters)
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+        centroids[filled] = np.add.reduceat(np.nan_to_num(vectors[order]), starts, axis=0)
+        empty = np.flatnonzero(counts == 0)  # restart empty clusters from random vectors
+        centroids[empty] = np.nan_to_num(vectors[rng.choice(len(vectors), len(empty), replace=False)])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            centroids = np.nan_to_num(centroids / np.linalg.norm(centroids, axis=1)[:, np.newaxis])
+    return centroids
+
+
+class IVFIndex(object):
+    """
+    Inverted file index for approximate cosine nearest neighbour search over unit-length vectors. The vectors are
+     partitioned by their nearest k-means centroid and a query only scans the lists of its `n_probe` nearest centroids.
+     More lists make the scanned lists shorter, more probes increase recall at the cost of speed.
+    """
+
+    def __init__(self, centroids, offsets, members, n_probe=None):
+        self.centroids = centroids
+        self.offsets = offsets  # list l holds members[offsets[l]:offsets[l + 1]]
+        self.members = members
+        self.n_probe = n_probe if n_probe else max(1, min(32, len(centroids)))
+
+    @classmethod
+    def build(cls, vectors, n_lists=None, n_iter=10, sample_size=None, n_probe=None, seed=0):
+        """
+        :param vectors: L2-normalized vectors, e.g. `Embeddings.L.vectors_norm`
+        :param n_lists: number of inverted lists (default: 4 * sqrt(number of vectors))
+        :param sample_size: number of vectors k-means is trained on (default: 64 per list)
+        """
+        n_lists = n_lists if n_lists else max(1, int(4 * np.sqrt(len(vectors))))
+        n_lists = min(n_lists, len(vectors))
+        sample_size = min(len(vectors), sample_size if sample_size else 64 * n_lists)
+        rng = np.random.RandomState(seed)
+        sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+
+        centroids = kmeans(sample, n_lists, n_iter=n_iter, seed=seed)
+        labels = _assign(vectors, centroids)
+        members = np.argsort(labels, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_lists))]).astype(np.int64)
+        return cls(centroids, offsets, members, n_probe=n_probe)
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, offsets=self.offsets, members=self.members,
+                 n_probe=np.array(self.n_probe))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['centroids'], f['offsets'], f['members'], n_probe=int(f['n_probe']))
+
+    def candidates(self, query, n_probe=None):
+        """
+        Indices of the vectors in the lists of the `n_probe` centroids nearest to `query`.
+        """
+        n_probe = min(n_probe if n_probe else self.n_probe, len(self.centroids))
+        scores = np.dot(self.centroids, query)
+        lists = np.argpartition(-scores, n_probe - 1)[:n_probe] if n_probe < len(scores) else range(len(scores))
+        return np.concatenate([self.members[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+
+    def search(self, vectors, query, topn=10, n_probe=None, exclude=()):
+        """
+        Approximate `topn` nearest neighbours of the unit-length `query` among `vectors`. Returns their indices and
+         cosine similarities, best first.
+        """
+        candidates = np.sort(self.candidates(query, n_probe))  # sorted indices read the vectors sequentially
+        if len(exclude):
+            candidates = candidates[~np.isin(candidates, exclude)]
+        scores = np.dot(vectors[candidates], query)
+        k = min(topn, len(candidates))
+        best = np.argpartition(-scores, k - 1)[:k] if 0 < k < len(scores) else np.arange(k)
+        best = best[np.argsort(-scores[best])]
+        return candidates[best], scores[best]
+
+    def recall(self, vectors, queries, topn=10, n_probe=None):
+        """
+        Mean recall@topn of the approximate search against the exact search, using the vectors at the indices
+         `queries` as queries (each query is excluded from its own results).
+        """
+        hits = 0
+        for i in queries:
+            scores = np.dot(vectors, vectors[i])
+            scores[i] = -np.inf
+            k = min(topn, len(scores) - 1)
+            exact = np.argpartition(-scores, k - 1)[:k]
+            approximate, _ = self.search(vectors, vectors[i], topn=k, n_probe=n_probe, exclude=[i])
+            hits += len(np.intersect1d(exact, approximate))
+        return hits / float(max(1, len(queries) * min(topn, len(vectors) - 1)))
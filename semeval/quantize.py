@@ -0,0 +1,345 @@
+import argparse
+import time
+import numpy as np
+from .common import *
+
+# number of vectors encoded or scored at a time
+CHUNK_SIZE = 65536
+
+METHODS = ['float16', 'int8', 'pq']
+
+
+class Float16Quantizer(object):
+    """
+    Stores the values as half-precision floats, halving the memory of the vectors.
+    """
+    method = 'float16'
+
+    def fit(self, vectors):
+        return self
+
+    def encode(self, vectors):
+        return np.asarray(vectors, dtype=np.float16)
+
+    def decode(self, codes):
+        return np.asarray(codes, dtype=np.float32)
+
+    def dot(self, queries, codes):
+        return np.dot(queries, self.decode(codes).T)
+
+    def params(self):
+        return {}
+
+    @classmethod
+    def from_params(cls, params):
+        return cls()
+
+
+class ScalarQuantizer(object):
+    """
+    Maps every dimension linearly from its range of values to the 256 values of an int8, using one scale and offset per
+     dimension. Uses a quarter of the memory of float32 vectors.
+    """
+    method = 'int8'
+
+    def __init__(self, scale=None, offset=None):
+        self.scale = scale
+        self.offset = offset
+
+    def fit(self, vectors):
+        lo = np.full(vectors.shape[1], np.inf, dtype=np.float32)
+        hi = np.full(vectors.shape[1], -np.inf, dtype=np.float32)
+        for start in range(0, len(vectors), CHUNK_SIZE):
+            m = np.nan_to_num(vectors[start:start + CHUNK_SIZE])
+            lo, hi = np.minimum(lo, m.min(axis=0)), np.maximum(hi, m.max(axis=0))
+        self.offset = lo
+        self.scale = np.where(hi > lo, (hi - lo) / 255, 1).astype(np.float32)
+        return self
+
+    def encode(self, vectors):
+        codes = np.rint((np.nan_to_num(vectors) - self.offset) / self.scale) - 128
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def decode(self, codes):
+        return (codes.astype(np.float32) + 128) * self.scale + self.offset
+
+    def dot(self, queries, codes):
+        # q . ((c + 128) * scale + offset) without decoding the codes
+        return np.dot(queries * self.scale, (codes.astype(np.float32) + 128).T) + \
+            np.dot(queries, self.offset)[:, np.newaxis]
+
+    def params(self):
+        return {'scale': self.scale, 'offset': self.offset}
+
+    @classmethod
+    def from_params(cls, params):
+        return cls(params['scale'], params['offset'])
+
+
+def _kmeans(vectors, n_clusters, n_iter=10, seed=0):
+    """
+    Euclidean k-means of a (small) sample of vectors.
+    """
+    rng = np.random.RandomState(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = _nearest(vectors, centroids)
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled][:, np.newaxis]
+    return centroids
+
+
+def _nearest(vectors, centroids):
+    distances = -2 * np.dot(vectors, centroids.T) + (centroids ** 2).sum(axis=1)
+    return np.argmin(distances, axis=1)
+
+
+class ProductQuantizer(object):
+    """
+    Product quantization (Jégou et al., 2011): the dimensions are split into `n_subvectors` groups and each group of a
+     vector is stored as the byte indexing the nearest of 256 centroids learned by k-means. Similarities are computed
+     asymmetrically, from the exact query and tables of its products with the centroids, without decoding the vectors.
+    """
+    method = 'pq'
+
+    def __init__(self, n_subvectors=None, n_centroids=256, centroids=None, n_iter=10, sample_size=65536, seed=0):
+        """
+        :param n_subvectors: number of groups of dimensions, i.e. bytes per vector (default: a quarter of the
+         dimensions)
+        """
+        self.n_subvectors = n_subvectors
+        self.n_centroids = n_centroids
+        self.centroids = centroids  # one (n_centroids, group dimensions) array per group
+        self.n_iter = n_iter
+        self.sample_size = sample_size
+        self.seed = seed
+
+    def _bounds(self):
+        dim = sum(c.shape[1] for c in self.centroids)
+        return np.cumsum([0] + [c.shape[1] for c in self.centroids])[:-1].tolist() + [dim]
+
+    def fit(self, vectors):
+        dim = vectors.shape[1]
+        n_subvectors = self.n_subvectors if self.n_subvectors else max(1, dim // 4)
+        rng = np.random.RandomState(self.seed)
+        sample = np.nan_to_num(np.asarray(
+            vectors[np.sort(rng.choice(len(vectors), min(len(vectors), self.sample_size), replace=False))],
+            dtype=np.float32))
+        n_centroids = min(self.n_centroids, len(sample))
+        self.centroids = [_kmeans(s, n_centroids, self.n_iter, self.seed)
+                          for s in np.array_split(sample, n_subvectors, axis=1)]
+        return self
+
+    def encode(self, vectors):
+        bounds = self._bounds()
+        vectors = np.nan_to_num(np.asarray(vectors, dtype=np.float32))
+        codes = np.empty((len(vectors), len(self.centroids)), dtype=np.uint8)
+        for s, c in enumerate(self.centroids):
+            codes[:, s] = _nearest(vectors[:, bounds[s]:bounds[s + 1]], c)
+        return codes
+
+    def decode(self, codes):
+        return np.concatenate([c[codes[:, s]] for s, c in enumerate(self.centroids)], axis=1)
+
+    def dot(self, queries, codes):
+        bounds = self._bounds()
+        scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for s, c in enumerate(self.centroids):
+            table = np.dot(queries[:, bounds[s]:bounds[s + 1]], c.T)  # products of the queries with the centroids
+            scores += table[:, codes[:, s]]
+        return scores
+
+    def params(self):
+        return {'centroid_{}'.format(s): c for s, c in enumerate(self.centroids)}
+
+    @classmethod
+    def from_params(cls, params):
+        n = len([k for k in params if k.startswith('centroid_')])
+        return cls(centroids=[params['centroid_{}'.format(s)] for s in range(n)])
+
+
+QUANTIZERS = {q.method: q for q in [Float16Quantizer, ScalarQuantizer, ProductQuantizer]}
+
+
+class QuantizedVectors(object):
+    """
+    Embeddings stored as the quantized codes of their unit-length vectors and their lengths. Scores against queries are
+     cosine similarities of the reconstructed vectors, as the reconstructions are rescaled to unit length.
+    """
+
+    def __init__(self, quantizer, codes, lengths, inv_norms, dim):
+        self.quantizer = quantizer
+        self.codes = codes
+        self.lengths = lengths  # lengths of the original vectors
+        self.inv_norms = inv_norms  # inverse lengths of the reconstructed unit vectors
+        self.dim = dim  # dimension of the vectors
+
+    @classmethod
+    def build(cls, vectors, method='int8', **kwargs):
+        """
+        :param vectors: the float vectors, e.g. memory-mapped
+        :param kwargs: options of the quantizer, e.g. `n_subvectors` for 'pq'
+        """
+        if method not in QUANTIZERS:
+            raise Exception("Unknown quantization '{}', use one of {}".format(method, METHODS))
+        lengths = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), CHUNK_SIZE):
+            lengths[start:start + CHUNK_SIZE] = np.linalg.norm(vectors[start:start + CHUNK_SIZE], axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(lengths > 0, 1 / lengths, 0).astype(np.float32)
+
+        quantizer = QUANTIZERS[method](**kwargs)
+        if method == 'pq':
+            rng = np.random.RandomState(quantizer.seed)
+            sample = np.sort(rng.choice(len(vectors), min(len(vectors), quantizer.sample_size), replace=False))
+            quantizer.fit(vectors[sample] * scale[sample][:, np.newaxis])
+        else:
+            quantizer.fit(_UnitRows(vectors, scale))
+
+        codes, inv_norms = None, np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), CHUNK_SIZE):
+            chunk = quantizer.encode(vectors[start:start + CHUNK_SIZE] * scale[start:start + CHUNK_SIZE, np.newaxis])
+            if codes is None:
+                codes = np.empty((len(vectors),) + chunk.shape[1:], dtype=chunk.dtype)
+            codes[start:start + len(chunk)] = chunk
+            inv_norms[start:start + len(chunk)] = _inverse_norms(quantizer.decode(chunk))
+        return cls(quantizer, codes, lengths, inv_norms, vectors.shape[1])
+
+    def dot(self, queries, rows=None):
+        """
+        Cosine similarities of the unit-length queries with the vectors (of the given rows), queries x vectors.
+        """
+        n = len(rows) if rows is not None else len(self.codes)
+        scores = np.empty((len(queries), n), dtype=np.float32)
+        for start in range(0, n, CHUNK_SIZE):
+            index = rows[start:start + CHUNK_SIZE] if rows is not None else slice(start, start + CHUNK_SIZE)
+            scores[:, start:start + CHUNK_SIZE] = self.quantizer.dot(queries, self.codes[index]) * self.inv_norms[index]
+        return scores
+
+    def subset(self, rows):
+        """
+        The vectors of the given rows; a slice of memory-mapped codes is not copied.
+        """
+        return QuantizedVectors(self.quantizer, self.codes[rows], self.lengths[rows], self.inv_norms[rows], self.dim)
+
+    def unit(self, rows):
+        return self.quantizer.decode(self.codes[rows]) * self.inv_norms[rows][:, np.newaxis]
+
+    def vectors(self, rows):
+        return self.unit(rows) * self.lengths[rows][:, np.newaxis]
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.lengths.nbytes + self.inv_norms.nbytes + \
+            sum(np.asarray(p).nbytes for p in self.quantizer.params().values())
+
+    def save(self, codes_path, params_path):
+        np.save(codes_path, self.codes)
+        np.savez(params_path, method=np.array(self.quantizer.method), dim=np.array(self.dim), lengths=self.lengths,
+                 inv_norms=self.inv_norms, **self.quantizer.params())
+
+    @classmethod
+    def load(cls, codes_path, params_path, mmap_mode=None):
+        with np.load(params_path) as f:
+            params = dict(f)
+        dim = int(params.pop('dim')) if 'dim' in params else None
+        quantizer = QUANTIZERS[str(params.pop('method'))].from_params(params)
+        codes = np.load(codes_path, mmap_mode=mmap_mode)
+        if dim is None:  # saved without it, decode a vector
+            dim = quantizer.decode(codes[:1]).shape[1]
+        return cls(quantizer, codes, params['lengths'], params['inv_norms'], dim)
+
+
+class _UnitRows(object):
+    """
+    Rows of vectors scaled to unit length on access, so that quantizers can be fitted chunk by chunk.
+    """
+
+    def __init__(self, vectors, scale):
+        self.vectors, self.scale, self.shape = vectors, scale, vectors.shape
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def __getitem__(self, index):
+        return self.vectors[index] * self.scale[index][:, np.newaxis]
+
+
+def _inverse_norms(vectors):
+    norms = np.linalg.norm(vectors, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(norms > 0, 1 / norms, 0).astype(np.float32)
+
+
+def drift(e, q, sample=1000, topn=10, seed=0):
+    """
+    Compares quantized embeddings `q` with the float32 embeddings `e` of the same language: the memory of both, and how
+     much `similarity` and `neighbours` of `sample` random words drift.
+
+    :return: the memory in bytes, the mean and maximum absolute error of the similarities of random pairs, the overlap
+     of the `topn` neighbours and the mean absolute error of the scores of the common neighbours
+    """
+    rng = np.random.RandomState(seed)
+    words = [e.L.index2word[i] for i in rng.choice(e.L_len, min(sample, e.L_len), replace=False)]
+    pairs = list(zip(words, rng.permutation(words)))
+
+    start = time.time()
+    exact_similarities = e.similarity_batch(pairs)
+    exact_neighbours = e.neighbours_batch(words, topn=topn)
+    exact_time = time.time() - start
+    start = time.time()
+    similarities = q.similarity_batch(pairs)
+    neighbours = q.neighbours_batch(words, topn=topn)
+    quantized_time = time.time() - start
+
+    errors = np.abs(similarities - exact_similarities)
+    overlap, score_errors = [], []
+    for exact, approximate in zip(exact_neighbours, neighbours):
+        exact, approximate = dict(exact), dict(approximate)
+        common = set(exact) & set(approximate)
+        overlap.append(len(common) / float(max(1, len(exact))))
+        score_errors.extend(abs(exact[w] - approximate[w]) for w in common)
+
+    norm = e.L.vectors_norm
+    memory = e.L.vectors.nbytes + (norm.nbytes if norm is not None and norm is not e.L.vectors else 0)
+    return {
+        'method': q.quantized.quantizer.method,
+        'memory': memory,
+        'quantized_memory': q.quantized.nbytes,
+        'memory_saved': 1 - q.quantized.nbytes / float(memory),
+        'similarity_error_mean': float(errors.mean()),
+        'similarity_error_max': float(errors.max()),
+        'neighbours_overlap': float(np.mean(overlap)),
+        'neighbours_score_error_mean': float(np.mean(score_errors)) if score_errors else None,
+        'seconds': exact_time,
+        'quantized_seconds': quantized_time,
+    }
+
+
+if __name__ == "__main__":
+    import json
+    from .embeddings import Embeddings
+    from . import convert
+
+    parser = argparse.ArgumentParser(description='semeval quantize embeddings and report how far the results drift')
+    parser.add_argument('-l', '--languages', nargs='+', help='<Required> languages to quantize', required=True)
+    parser.add_argument('-m', '--methods', nargs='+', default=METHODS, help='quantization methods (default: all)')
+    parser.add_argument('--sample', type=int, default=1000, help='number of words compared')
+    parser.add_argument('--topn', type=int, default=10, help='number of neighbours compared')
+    parser.add_argument('--compile', action='store_true',
+                        help='save the quantized vectors next to the compiled model, for `Embeddings(lang, '
+                             'quantization=...)`')
+    args = parser.parse_args()
+
+    for language in args.languages:
+        e = Embeddings(language, mmap=convert.is_compiled(language))
+        for method in args.methods:
+            if args.compile:
+                convert.compile_quantized(language, method)
+                q = Embeddings(language, quantization=method)
+            else:
+                q = e.quantize(method)
+            print(language, json.dumps(drift(e, q, sample=args.sample, topn=args.topn)))
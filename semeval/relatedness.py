@@ -1,75 +1,175 @@
-from semeval.common import download_path
-import hickle as hkl
+from semeval.common import download_path, LRUCache, timer, NULL_TIMER
+from semeval import convert
 import numpy as np
 import io
-from sklearn import preprocessing
+import os
+import json
+import multiprocessing
+from scipy import sparse
 import pathlib
 
+# the model used by the worker processes of `Relatedness.interpret_many`, inherited when they are forked
+_pool_model = None
+# upper bound of the number of elements of the dense rows summed at once by `l1_row_norms`
+DENSE_ELEMENTS = 2 ** 22
+
+
+def top_k(values, k):
+    """
+    Positions of the `k` highest `values`, best first, selected with `argpartition`. Ties are broken by position, as a
+     stable sort of all values would.
+    """
+    if 0 < k < len(values):
+        kth = -np.partition(-values, k - 1)[k - 1]
+        above = np.flatnonzero(values > kth)
+        selected = np.sort(np.concatenate([above, np.flatnonzero(values == kth)[:k - len(above)]]))
+    else:
+        selected = np.arange(len(values))
+    return selected[np.argsort(-values[selected], kind='stable')]
+
+
+def dense_l1_norm(cols, scores, n_cols):
+    """
+    The l1 norm of a row given by its nonzeros, summed over the whole dense row in the dtype of the scores as the
+     former scikit-learn normalization did; the position of the zeros changes the rounding of numpy's pairwise sums.
+    """
+    row = np.zeros(n_cols, dtype=scores.dtype)
+    row[cols] = np.abs(scores)
+    return row.sum()
+
+
+def l1_row_norms(matrix):
+    """
+    The l1 norm of every row of a CSR matrix, summed like `dense_l1_norm` over chunks of rows densified at once.
+    """
+    rows = max(1, DENSE_ELEMENTS // max(matrix.shape[1], 1))
+    norms = np.empty(matrix.shape[0], dtype=matrix.dtype)
+    for start in range(0, matrix.shape[0], rows):
+        norms[start:start + rows] = np.abs(matrix[start:start + rows].toarray()).sum(axis=1)
+    return norms
 
-class Relatedness:
-    def __init__(self, lang='eng'):
 
-        rows_path = "{}{}-relatedness-{}.{}".format(download_path(), lang, 'rows', 'txt')
-        cols_path = "{}{}-relatedness-{}.{}".format(download_path(), lang, 'cols', 'txt')
-        matrix_path = "{}{}-relatedness-{}.{}".format(download_path(), lang, 'model', 'hkl')
+class Relatedness:
+    def __init__(self, lang='eng', mmap=False, prenormalize=True, cache_size=1024):
+        """
+        :param mmap: open the compiled CSR arrays (see `python -m semeval.convert -m relatedness`) with memory mapping
+         instead of decompressing the hickle matrix. Rows are then read from disk on demand and processes on the same
+         host share the pages of the OS page cache.
+        :param prenormalize: compute the l1 norms of all rows once at load time (read from the compiled norms when
+         memory mapping) instead of summing every row when it is normalized
+        :param cache_size: number of decoded and sorted rows kept in an LRU cache (0 to disable it), see `cache.stats()`
+        """
+        paths = convert.relatedness_paths(lang)
+        rows_path, cols_path, matrix_path = paths['rows'], paths['cols'], paths['model']
 
         if not pathlib.Path(rows_path).is_file() or \
                 not pathlib.Path(cols_path).is_file() or \
-                not pathlib.Path(matrix_path).is_file():
+                not (mmap or pathlib.Path(matrix_path).is_file()):
             raise Exception(
                 "Relatedness models are not download. Download them using `python -m semeval.download -m relatedness -l {}`"
                     .format(lang)
             )
 
-        # get the rows and their indecies
-        self.rows = Relatedness.load_termidx(rows_path)
-        # get the columns and their indecies
-        self.cols = Relatedness.load_termidx(cols_path)
+        # the indices of the row and column terms, `Vocabulary` objects shared when both are the same terms
+        if mmap:
+            self.rows, self.cols = convert.load_relatedness_vocab(lang)
+        else:
+            self.rows, self.cols = convert.read_relatedness_vocab(lang)
         # load the matrix
-        self.matrix = hkl.load(matrix_path)
-
-        self.rev_cols = {i: r for r, i in self.cols.items()}
-        sorted_cols = sorted(self.cols.items(), key=lambda k: k[1])
-        self.sorted_cols = [r[0] for r in sorted_cols]
-
-    @staticmethod
-    def load_termidx(filename):
-        with io.open(filename, 'r', encoding='utf-8') as f:
-            rows = f.readlines()
-            rows = [r.rstrip('\n').split('\t')[0] for r in rows]
-            return dict([(w, i) for i, w in enumerate(rows)])
+        if mmap:
+            self.matrix = convert.load_relatedness(lang)  # already in canonical format
+        else:
+            import hickle as hkl
+            self.matrix = hkl.load(matrix_path)
+            if not sparse.isspmatrix_csr(self.matrix):
+                self.matrix = sparse.csr_matrix(self.matrix)
+            if not self.matrix.has_canonical_format:  # rows are read straight from the CSR arrays
+                self.matrix.sum_duplicates()
+
+        self.row_norms = None
+        if prenormalize and not mmap:
+            self.row_norms = l1_row_norms(self.matrix)
+        elif prenormalize and os.path.isfile(paths['norms']):
+            self.row_norms = np.load(paths['norms'], mmap_mode='r')
+        self.cache = LRUCache(cache_size) if cache_size > 0 else None
+
+    def get_row(self, word, normalize=True):
+        """
+        The column indices and scores of the nonzero relatedness scores of a word, read straight from the CSR arrays
+         of the matrix without densifying the row. Raises a KeyError for unknown words.
+        """
+        i = self.rows[word]  # get the index of the word in the matrix
+        start, end = self.matrix.indptr[i], self.matrix.indptr[i + 1]
+        cols = self.matrix.indices[start:end]
+        scores = self.matrix.data[start:end]
+        if normalize:  # l1 normalization of the row
+            norm = self.row_norms[i] if self.row_norms is not None else \
+                dense_l1_norm(cols, scores, self.matrix.shape[1])
+            scores = scores / norm if norm != 0 else scores.copy()
+        return cols, scores
 
     def get_vector(self, word, normalize=True):
         try:
-            i = self.rows[word]  # get the index of the word in the matrix
-            row = self.matrix[i, :].A[0]  # get it's relatedness vector/row
-            if normalize:
-                row = preprocessing.normalize(row[:, np.newaxis], axis=0, norm='l1').ravel()
+            cols, scores = self.get_row(word, normalize)
+            row = np.zeros(self.matrix.shape[1], dtype=scores.dtype)  # get it's relatedness vector/row
+            row[cols] = scores
             return row
         except Exception as e:
             return None
 
+    def _positive_row(self, word, normalize=True):
+        cols, scores = self.get_row(word, normalize)
+        keep = (scores > 0) & (cols < len(self.cols))  # remove non-related words
+        return cols[keep], scores[keep]
+
+    def _sorted_row(self, word, normalize=True, k=0):
+        """
+        The positive scores of a word and their columns sorted by decreasing score, served from the cache when possible.
+         Without a cache only the `k` (0 for all) highest scores are selected; cached rows are sorted whole.
+        """
+        row = self.cache.get((word, normalize)) if self.cache is not None else None
+        if row is None:
+            cols, scores = self._positive_row(word, normalize)
+            if self.cache is None:
+                order = top_k(scores, k)
+                return cols[order], scores[order]
+            order = top_k(scores, 0)
+            row = (cols[order], scores[order])
+            for a in row:
+                a.flags.writeable = False  # shared by every caller
+            if self.cache is not None:
+                self.cache.put((word, normalize), row)
+        return row
+
     def get_rel(self, word, normalize=True, positive=True):
         try:
-            i = self.rows[word]  # get the index of the word in the matrix
-            row = self.matrix[i, :].A[0]  # get it's relatedness vector/row
-            if normalize:
-                row = preprocessing.normalize(row[:, np.newaxis], axis=0, norm='l1').ravel()
-            row = zip(self.sorted_cols, row)  # word: relatedness_score
             if positive:
-                row = [r for r in row if r[1] > 0]  # remove non-related words
-            row = dict(row)
-            return row
+                cols, scores = self._positive_row(word, normalize)
+                return dict(zip(self.cols.terms(cols), scores))  # word: relatedness_score
+            return dict(zip(self.cols, self.get_vector(word, normalize)))
         except Exception as e:
             return None
 
     def get_sorted_rel(self, word, normalize=True, positive=True, k=0):
-        row = self.get_rel(word, normalize, positive)
-        if row:
-            row = sorted(row.items(), key=lambda k: k[1], reverse=True)
-            if k > 0 and k < len(row):
-                row = row[:k]
-        return row
+        if not positive:
+            row = self.get_rel(word, normalize, positive)
+            if row:
+                row = sorted(row.items(), key=lambda k: k[1], reverse=True)
+                if k > 0 and k < len(row):
+                    row = row[:k]
+            return row
+
+        t = timer('relatedness.get_sorted_rel')
+        try:
+            cols, scores = self._sorted_row(word, normalize, k)
+        except Exception as e:
+            return None
+        if k > 0 and k < len(cols):
+            cols, scores = cols[:k], scores[:k]
+        t.mark('compute')
+        result = list(zip(self.cols.terms(cols), scores))
+        t.mark('serialize')
+        return result
 
     def interpret(self, tenor, vehicle):
         """
@@ -78,67 +178,174 @@ class Relatedness:
          Interpretation Using Corpus-Derived Word Associations. In Proceedings of The Seventh International Conference
          on Computational Creativity (pp. 230-237). Sony CSL Paris.
         """
-        tv = self.get_vector(tenor)
-        vv = self.get_vector(vehicle)
-
-        if tv is None or vv is None:
+        t = timer('relatedness.interpret')
+        try:
+            tv = self._positive_row(tenor)
+            vv = self._positive_row(vehicle)
+        except Exception as e:
             return []
+        t.mark('lookup')
+        return self._interpret(tv, vv, t)
 
-        features = np.union1d(np.where(tv > 0), np.where(vv > 0))  # all non-zero features
-        shared_features = np.intersect1d(np.where(tv > 0), np.where(vv > 0))  # shared features
+    def _interpret(self, tv, vv, t=NULL_TIMER):
+        (t_cols, t_scores), (v_cols, v_scores) = tv, vv
 
-        # consider only concrete features? add filter here (e.g., certain POS tags)
+        features = np.union1d(t_cols, v_cols)  # all non-zero features
+        shared_features, t_shared, v_shared = np.intersect1d(t_cols, v_cols, assume_unique=True,
+                                                             return_indices=True)  # shared features
+        shared = np.searchsorted(features, shared_features)  # positions of the shared features among all features
 
-        mv = np.zeros(tv.shape)
-        mv[shared_features] = tv[shared_features] * vv[shared_features]  # multiplication
-        mv = mv[features]
+        # consider only concrete features? add filter here (e.g., certain POS tags)
 
-        odv = np.zeros(tv.shape)
-        odv[features] = float('-inf')
-        odv[shared_features] = vv[shared_features] - tv[shared_features]  # overlap difference
-        odv = odv[features]
+        mv = np.zeros(len(features))
+        mv[shared] = t_scores[t_shared] * v_scores[v_shared]  # multiplication
 
-        # sort them and convert back into ordered features
-        mvf = np.argsort(-mv)
-        odvf = np.argsort(-odv)
+        odv = np.full(len(features), float('-inf'))
+        odv[shared] = v_scores[v_shared] - t_scores[t_shared]  # overlap difference
 
-        mvf_l = mvf.tolist()
-        odvf_l = odvf.tolist()
+        # sort them and invert the orders into the rank of every feature
+        ranks = np.arange(len(features))
+        mv_rank = np.empty(len(features), dtype=np.int64)
+        mv_rank[np.argsort(-mv)] = ranks
+        odv_rank = np.empty(len(features), dtype=np.int64)
+        odv_rank[np.argsort(-odv)] = ranks
 
         # ranked interpretations
-        interpretations = [(self.rev_cols[features[f]], min([mvf_l.index(f), odvf_l.index(f)])) for f in
-                           range(len(features))]
-        return list(sorted(interpretations, key=lambda k: k[1]))
+        combined = np.minimum(mv_rank, odv_rank)
+        order = np.argsort(combined, kind='stable')
+        t.mark('compute')
+        result = list(zip(self.cols.terms(features[order]), combined[order].tolist()))
+        t.mark('serialize')
+        return result
+
+    def interpret_many(self, pairs, topn=0, processes=None):
+        """
+        `interpret` for many (tenor, vehicle) pairs. The row of each distinct word is fetched once, and with
+         `processes` > 1 the pairs are split across a pool of forked processes sharing the loaded matrix.
+
+        :param topn: keep only the `topn` best interpretations of each pair (0 to keep all)
+        """
+        pairs = list(pairs)
+        if processes and processes > 1 and len(pairs) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            global _pool_model
+            _pool_model = self
+            size = -(-len(pairs) // (processes * 4))
+            chunks = [(pairs[i:i + size], topn) for i in range(0, len(pairs), size)]
+            try:
+                with multiprocessing.get_context('fork').Pool(processes) as pool:
+                    return [r for chunk in pool.map(_interpret_chunk, chunks) for r in chunk]
+            finally:
+                _pool_model = None
+
+        rows = {}
+        results = []
+        for tenor, vehicle in pairs:
+            t = timer('relatedness.interpret')
+            for word in (tenor, vehicle):
+                if word not in rows:
+                    try:
+                        rows[word] = self._positive_row(word)
+                    except Exception as e:
+                        rows[word] = None
+            t.mark('lookup')
+            if rows[tenor] is None or rows[vehicle] is None:
+                results.append([])
+                continue
+            interpretations = self._interpret(rows[tenor], rows[vehicle], t)
+            results.append(interpretations[:topn] if topn > 0 else interpretations)
+        return results
 
     def metaphoricity(self, tenor, vehicle, expression, k=0, normalize=True):
         """
         Metaphoricity scores as described in Alnajjar, K., & Toivonen, H. (2020). Computational Generation of Slogans.
          Natural Language Engineering. https://doi.org/10.1017/S1351324920000236
         """
-        tv = self.get_sorted_rel(tenor, normalize=normalize)
-        vv = self.get_sorted_rel(vehicle, normalize=normalize)
-
-        if not tv or not vv:
-            return 0.0
-
-        if k == 0:
-            pass
-        elif k > 0 and k < len(self.rows):
-            tv = tv[:k]
-            vv = vv[:k]
-        else:
-            raise Exception("k must be positive and less than %s" % len(self.rows))
+        return next(self.metaphoricity_many([(tenor, vehicle, expression)], k=k, normalize=normalize))
 
-        tv = dict(tv)
-        vv = dict(vv)
+    def _top_row(self, word, k=0, normalize=True):
+        """
+        The `k` (0 for all) highest positive relatedness scores of a word as column indices in ascending order and
+         their scores, or None for unknown words.
+        """
+        try:
+            cols, scores = self._sorted_row(word, normalize, k)
+        except Exception as e:
+            return None
+        if not len(cols):
+            return None
+        best = np.argsort(cols[:k] if k > 0 else cols)
+        return cols[best], scores[best].astype(np.float64)
 
-        t_relatedness = np.max([tv.get(t, 0.0) for t in expression])  # relatedness to tenor
-        v_relatedness = np.max([vv.get(t, 0.0) for t in expression])  # relatedness to vehicle
-        tv_score = t_relatedness * v_relatedness
+    @staticmethod
+    def _lookup(row, indices):
+        cols, scores = row
+        positions = np.minimum(np.searchsorted(cols, indices), len(cols) - 1)
+        return np.where((cols[positions] == indices) & (indices >= 0), scores[positions], 0.0)
 
-        vt_diff = np.max([vv.get(t, 0.0) - tv.get(t, 0.0) for t in expression])  # vehicle tenor difference
+    def metaphoricity_many(self, records, k=0, normalize=True, cache_size=10000):
+        """
+        Yields the `metaphoricity` scores of every (tenor, vehicle, expression) record, in order. The top `k`
+         relatedness of each tenor and vehicle is computed once and cached, and the tokens of each expression are
+         scored with vectorized lookups.
+
+        :param records: an iterable of (tenor, vehicle, expression) tuples or of dicts with these keys, or the path or
+         file object of a JSONL stream of such records. An expression is a list of tokens; strings are split on
+         whitespace.
+        :param cache_size: number of words whose top relatedness is kept
+        """
+        if k < 0 or k >= len(self.rows):
+            raise Exception("k must be positive and less than %s" % len(self.rows))
 
-        return tv_score, vt_diff, np.mean([tv_score, vt_diff]) if tv_score > 0 and vt_diff > 0 else 0.0
+        rows = {}
+        for tenor, vehicle, expression in _read_records(records):
+            t = timer('relatedness.metaphoricity')
+            for word in (tenor, vehicle):
+                if word not in rows:
+                    if len(rows) >= cache_size:
+                        rows.pop(next(iter(rows)))  # forget the oldest word
+                    rows[word] = self._top_row(word, k, normalize)
+            tv, vv = rows[tenor], rows[vehicle]
+
+            if tv is None or vv is None:
+                yield 0.0
+                continue
+
+            indices = self.cols.indices(expression)
+            t.mark('lookup')
+            t_scores = self._lookup(tv, indices)
+            v_scores = self._lookup(vv, indices)
+
+            t_relatedness = np.max(t_scores)  # relatedness to tenor
+            v_relatedness = np.max(v_scores)  # relatedness to vehicle
+            tv_score = t_relatedness * v_relatedness
+
+            vt_diff = np.max(v_scores - t_scores)  # vehicle tenor difference
+            t.mark('compute')
+
+            yield tv_score, vt_diff, np.mean([tv_score, vt_diff]) if tv_score > 0 and vt_diff > 0 else 0.0
+
+
+def _read_records(records):
+    if isinstance(records, (str, pathlib.Path)):
+        with io.open(records, 'r', encoding='utf-8') as f:
+            for r in _read_records(f):
+                yield r
+        return
+
+    for r in records:
+        if isinstance(r, str):  # a line of a JSONL stream
+            if not r.strip():
+                continue
+            r = json.loads(r)
+        if isinstance(r, dict):
+            r = (r['tenor'], r['vehicle'], r['expression'])
+        tenor, vehicle, expression = r
+        yield tenor, vehicle, expression.split() if isinstance(expression, str) else expression
+
+
+def _interpret_chunk(args):
+    pairs, topn = args
+    return _pool_model.interpret_many(pairs, topn=topn)
 
 
 def main():
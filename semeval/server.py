@@ -1,21 +1,66 @@
+import os
+import json
 import uvicorn
 import argparse
-from semeval.serviecs import embeddings
+from semeval import shared
+from semeval.serviecs import embeddings, relatedness
 
 if __name__ == '__main__':
     p = argparse.ArgumentParser()
     p.add_argument("--host", default=None, help="Hostname (default: localhost)")
     p.add_argument("--port", default=None, help="Port (default: 1337)")
-    p.add_argument("--service", required=True, help="The service to run (e.g. embeddings)")
+    p.add_argument("--service", required=True, help="The service to run (embeddings or relatedness)")
+    p.add_argument("--languages", nargs='+', default=[], help="Languages to load at startup")
+    p.add_argument("--mmap", action='store_true', help="Open compiled models memory-mapped (see semeval.convert)")
+    p.add_argument("--workers", type=int, default=1,
+                   help="Number of worker processes, the models are loaded once and shared by all workers "
+                        "(default: 1)")
+    p.add_argument("--cache-size", type=int, default=0,
+                   help="Number of results of expensive queries kept in a cache (default: 0, no cache)")
+    p.add_argument("--cache-bytes", type=int, default=None, help="Maximum size of the cached results in bytes")
+    p.add_argument("--cache-ttl", type=float, default=None, help="Seconds a cached result is served for")
+    p.add_argument("--cache-endpoints", nargs='+', default=None,
+                   help="Endpoints whose results are cached (default: neighbours most_similar analogy theme align for "
+                        "embeddings, get_sorted_rel interpret for relatedness)")
+    p.add_argument("--memory-budget", type=int, default=None,
+                   help="Memory available for the models in MB, the least recently used languages are unloaded to "
+                        "stay within it (default: no limit)")
+    p.add_argument("--retry-after", type=int, default=5,
+                   help="Seconds after which clients retry while a model is loading (default: 5)")
+    p.add_argument("--max-vocab", type=int, default=None,
+                   help="Serve only the most frequent words of the embeddings (default: all)")
+    p.add_argument("--quantization", default=None, choices=['float16', 'int8', 'pq'],
+                   help="Serve the embeddings quantized by `python -m semeval.convert -m float16|int8|pq`")
+    p.add_argument("--timings", action='store_true',
+                   help="Export the time spent in the lookup, compute and serialize phases of the model methods at "
+                        "/metrics/ (default: only the request metrics)")
     args = p.parse_args()
 
     services = {
         'embeddings': embeddings.EmbeddingsServer,
+        'relatedness': relatedness.RelatednessServer,
+    }
+    # services that support multiple workers: the app factory of the workers and the function sharing the models
+    shared_services = {
+        'embeddings': ('semeval.serviecs.embeddings:SharedEmbeddingsServer', shared.share_embeddings),
     }
 
     if args.service not in services:
         raise Exception("Service '{}' not available!".format(args.service))
 
-    uvicorn.run(services[args.service](**args.__dict__),
-                host=args.host if args.host else "localhost",
-                port=int(args.port) if args.port else 1337)
+    host = args.host if args.host else "localhost"
+    port = int(args.port) if args.port else 1337
+
+    if args.workers > 1:
+        if args.service not in shared_services or args.quantization:
+            raise Exception("Service '{}' cannot run with multiple workers!".format(args.service))
+        app, share = shared_services[args.service]
+        spec, blocks = share(args.languages, mmap=args.mmap, max_vocab=args.max_vocab)
+        os.environ[shared.ENV_VAR] = json.dumps(spec)
+        os.environ[shared.OPTIONS_VAR] = json.dumps(args.__dict__)
+        try:
+            uvicorn.run(app, factory=True, workers=args.workers, host=host, port=port)
+        finally:
+            shared.release(blocks)
+    else:
+        uvicorn.run(services[args.service](**args.__dict__), host=host, port=port)
@@ -0,0 +1,180 @@
+import json
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from semeval.common import LRUCache
+from semeval.serviecs.manager import LOADING, FAILED, TOO_LARGE
+
+
+def add_loading_middleware(app, models, languages, params=('lang',), retry_after=5):
+    """
+    Makes the requests for a language wait for its model: the model is loaded in the background by `models` (a
+     `ModelManager`) while the server answers with 503 and a Retry-After header, and a failed load is answered with 500.
+     Languages whose models do not fit together in the memory budget are answered with 507. The models of a request
+     are kept loaded until it is answered, and its handler reads them from `request.state.models`.
+
+    :param languages: the languages the service supports, requests for other languages are passed through
+    :param params: the query parameters holding languages
+    """
+    from fastapi import Request
+    from fastapi.responses import JSONResponse
+
+    @app.middleware("http")
+    async def load_language(request: Request, call_next):
+        langs = [request.query_params.get(_lang_k) for _lang_k in params]
+        langs = [lang for lang in langs if lang is not None and lang in languages]
+        status = models.acquire(langs)
+        if status['state'] == LOADING:
+            return JSONResponse({'error': "The model of language '{}' is loading, retry later".format(status['lang'])},
+                                status_code=503, headers={'Retry-After': str(retry_after)})
+        elif status['state'] == FAILED:
+            return JSONResponse({'error': status['error']}, status_code=500)
+        elif status['state'] == TOO_LARGE:
+            return JSONResponse({'error': status['error']}, status_code=507)
+
+        request.state.models = status['models']
+        try:
+            return await call_next(request)
+        finally:
+            models.release(langs)
+
+
+class ResponseCache(object):
+    """
+    Caches the JSON bodies of the responses of the expensive endpoints of a service in an `LRUCache`.
+
+    :param cache_size: number of cached responses (0 to disable the cache)
+    :param cache_bytes: bound of the size of the cached response bodies in bytes
+    :param cache_ttl: seconds a cached result is served for
+    :param endpoints: endpoints whose results are cached
+    """
+
+    def __init__(self, cache_size=0, cache_bytes=None, cache_ttl=None, endpoints=()):
+        self.cache = None
+        if cache_size or cache_bytes:
+            self.cache = LRUCache(cache_size or None, max_bytes=cache_bytes, ttl=cache_ttl)
+        self.endpoints = set(endpoints)
+
+    def __call__(self, key, compute):
+        """
+        The JSON response of a request, served from the cache when possible. The key starts with the endpoint name and
+         holds the normalized parameters; `compute` returns the content of the response.
+        """
+        from fastapi.responses import JSONResponse, Response
+
+        if self.cache is None or key[0] not in self.endpoints:
+            return JSONResponse(compute())
+        body = self.cache.get(key)
+        if body is None:
+            body = JSONResponse(compute()).body
+            self.cache.put(key, body, size=len(body))
+        return Response(body, media_type='application/json')
+
+    def stats(self):
+        if self.cache is None:
+            return {'enabled': False}
+        return dict(self.cache.stats(), enabled=True, endpoints=sorted(self.endpoints))
+
+    def clear(self):
+        if self.cache is not None:
+            self.cache.clear()
+        return self.cache is not None
+
+
+def add_status_routes(app, models, cache):
+    """
+    Serves the state of the models at `/models/` and the statistics of the response cache at `/cache/`, which is
+     cleared by DELETE.
+    """
+    from fastapi.responses import JSONResponse
+
+    @app.get("/models/")
+    def models_status():
+        return JSONResponse(models.status())
+
+    @app.get("/cache/")
+    def cache_stats():
+        return JSONResponse(cache.stats())
+
+    @app.delete("/cache/")
+    def cache_clear():
+        return JSONResponse({'cleared': cache.clear()})
+
+
+class ServiceAPI(object):
+    def __init__(self, host='http://localhost', port=1337, path='', cache_size=0, pool_size=10, retries=3,
+                 timeout=None):
+        """
+        :param cache_size: number of responses kept in an LRU cache keyed on the endpoint and its parameters
+         (0 to disable it), see `cache.stats()`
+        :param pool_size: number of kept-alive connections to the server
+        :param retries: number of retries of failed connections and of 502, 503 and 504 responses of idempotent
+         requests (not of the batch POST endpoints), waiting as long as the Retry-After header of a loading model says
+        """
+        self.host = host
+        self.port = port
+        self.path = path
+        self.baseurl = host + ':' + str(port) + path
+        self.timeout = timeout
+        self.cache = LRUCache(cache_size) if cache_size > 0 else None
+
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.1, status_forcelist=(502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def map(self, method, calls, max_workers=8):
+        """
+        Calls a method of the client (e.g. 'neighbours') once per item of `calls` from a pool of threads, with at most
+         `max_workers` requests in flight. Each item is a dict of keyword arguments or a tuple of positional arguments.
+         Like `map`, yields the results lazily and in order.
+        """
+        fn = getattr(self, method) if isinstance(method, str) else method
+
+        def call(args):
+            return fn(**args) if isinstance(args, dict) else fn(*args)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            for args in calls:
+                pending.append(executor.submit(call, args))
+                if len(pending) >= 2 * max_workers:  # bound the number of queued calls
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def get_response(self, url, params={}):
+        return self.request('GET', url, params)
+
+    def post_response(self, url, params={}, data=None):
+        return self.request('POST', url, params, data)
+
+    def request(self, method, url, params={}, data=None):
+        key = None
+        if self.cache is not None:
+            key = (method, url, _freeze(params), json.dumps(data, sort_keys=True))
+            content = self.cache.get(key)
+            if content is not None:
+                return content
+
+        response = self.session.request(method, url, params=params, json=data, timeout=self.timeout)
+        content = self.check_response(response)
+        if key is not None:
+            self.cache.put(key, content)
+        return content
+
+    def check_response(self, response):
+        if response.status_code != 200:
+            content = json.loads(response.content)
+            if 'error' in content:
+                raise Exception(content['error'])
+            else:
+                raise Exception("Error... Response received: {}".format(content))
+        return response.content
+
+
+def _freeze(params):
+    return tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in params.items()))
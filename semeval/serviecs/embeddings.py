@@ -1,152 +1,265 @@
 from typing import Optional, List
-from fastapi import FastAPI, Query, Request, HTTPException
-from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
 import ujson as json
-from semeval.embeddings import Embeddings
 import json
 import requests
 from semeval.common import *
+from semeval.serviecs.manager import ModelManager, files_size
+from semeval.serviecs.common import add_loading_middleware, add_status_routes, ResponseCache, ServiceAPI
+from semeval.serviecs.metrics import add_metrics_route, service_metrics
+
+
+def encode_array(arr):
+    """
+    Binary encoding of float arrays: the number of dimensions and the size of each as little-endian uint32, followed
+     by the values as little-endian float32.
+    """
+    import numpy as np
+    arr = np.ascontiguousarray(arr, dtype='<f4')
+    return np.array([arr.ndim] + list(arr.shape), dtype='<u4').tobytes() + arr.tobytes()
+
+
+def decode_array(content):
+    """
+    Decodes an array encoded by `encode_array`. The returned read-only array is a view of `content`, nothing is copied.
+    """
+    import numpy as np  # only the batch methods of the client need it
+    ndim = int(np.frombuffer(content, dtype='<u4', count=1)[0])
+    shape = tuple(int(x) for x in np.frombuffer(content, dtype='<u4', count=ndim, offset=4))
+    return np.frombuffer(content, dtype='<f4', offset=4 * (ndim + 1)).reshape(shape)
+
+
+def embeddings_size(e):
+    if e.quantized is not None:
+        return e.quantized.nbytes
+    norm = e.L.vectors_norm
+    return e.L.vectors.nbytes + (norm.nbytes if norm is not None and norm is not e.L.vectors else 0)
+
+
+def embeddings_estimate(lang, quantization=None, max_vocab=None):
+    """
+    The size of the compiled files of the embeddings of a language, which `embeddings_size` is close to once they are
+     loaded, or None if they are not compiled.
+    """
+    from semeval import convert
+    if quantization is not None:
+        paths = convert.quantized_paths(lang, quantization)
+        return files_size([paths['codes'], paths['params']])
+    paths = convert.embeddings_paths(lang, max_vocab)
+    return files_size([paths['vectors'], paths['norm']])
+
+
+# endpoints whose results are cached by default, they scan the whole vocabulary
+CACHED_ENDPOINTS = ['neighbours', 'most_similar', 'analogy', 'theme', 'align']
 
 
 def EmbeddingsServer(*args, **kwargs):
-    models = {}
+    """
+    :param cache_size: number of results of the expensive endpoints kept in an LRU cache (0 to disable it)
+    :param cache_bytes: bound of the size of the cached response bodies in bytes
+    :param cache_ttl: seconds a cached result is served for
+    :param cache_endpoints: endpoints whose results are cached (default: `CACHED_ENDPOINTS`)
+    :param memory_budget: maximum memory used by the loaded models in MB, the least recently used languages are
+     unloaded to stay within it
+    :param retry_after: seconds after which clients are told to retry while a model is loading
+    :param quantization: serve the vectors compiled as 'float16', 'int8' or 'pq' codes (see `semeval.quantize`)
+    :param max_vocab: serve only the most frequent words of every language
+    :param timings: export the phase timings of the `Embeddings` methods at `/metrics/` along with the request metrics
+    """
+    # imported here, so that the client `EmbeddingsAPI` loads neither the web framework nor gensim
+    from fastapi import FastAPI, Query, Body, Request
+    from fastapi.responses import JSONResponse, Response
+    from semeval.embeddings import Embeddings
+
+    mmap = kwargs.get('mmap', False)
+    budget = kwargs.get('memory_budget')
+    quantization = kwargs.get('quantization')
+
+    def load(lang):
+        e = Embeddings(lang, mmap=mmap, quantization=quantization, max_vocab=kwargs.get('max_vocab'))
+        if quantization is None:
+            e.L.init_sims()  # normalize before serving, so that the first query is not slow and the size is known
+        return e
+
+    metrics = service_metrics()
+    models = ModelManager(load, size=embeddings_size,
+                          memory_budget=budget * 1024 * 1024 if budget else None, models=kwargs.get('models'),
+                          estimate=lambda lang: embeddings_estimate(lang, quantization, kwargs.get('max_vocab')),
+                          on_load=lambda lang, seconds: metrics.observe('semeval_model_load_duration_seconds', seconds,
+                                                                        lang=lang))
     app = FastAPI()
+    cached = ResponseCache(kwargs.get('cache_size'), kwargs.get('cache_bytes'), kwargs.get('cache_ttl'),
+                           endpoints=kwargs.get('cache_endpoints') or CACHED_ENDPOINTS)
 
-    for lang in kwargs.get('languages', []):
-        models[lang] = Embeddings(lang)
+    for lang in kwargs.get('languages') or []:  # preloaded in the background
+        if lang not in models:
+            models.load(lang)
 
-    def filter_words(lang, words):
+    def filter_words(model, words):
         if words is None:
             return
-        return [word for word in words if word in models[lang].L.vocab]
+        return [word for word in words if word in model.L.vocab]
 
-    def check_language(lang):
-        if lang not in models and lang in supported_languages():
-            models[lang] = Embeddings(lang)
-
-    @app.middleware("http")
-    async def load_language(request: Request, call_next):
-        try:
-            for _lang_k in ['lang', 'lang1', 'lang2']:
-                if _lang_k in request.query_params:
-                    check_language(request.query_params[_lang_k])
-        except Exception as e:
-            return JSONResponse({'error': str(e)}, status_code=500)
-
-        response = await call_next(request)
-        return response
+    add_loading_middleware(app, models, supported_languages(), params=('lang', 'lang1', 'lang2'),
+                           retry_after=kwargs.get('retry_after') or 5)
+    add_metrics_route(app, models, metrics, timings=kwargs.get('timings', False))
+    add_status_routes(app, models, cached)
 
     @app.get("/n_similarity/")
-    def n_similarity(lang: str, ws1: List[str] = Query([]), ws2: List[str] = Query([])):
+    def n_similarity(request: Request, lang: str, ws1: List[str] = Query([]), ws2: List[str] = Query([])):
         try:
-            ws1 = filter_words(lang, ws1)
-            ws2 = filter_words(lang, ws2)
-            return models[lang].L.n_similarity(ws1, ws2)
+            model = request.state.models[lang]
+            ws1 = filter_words(model, ws1)
+            ws2 = filter_words(model, ws2)
+            return float(model.n_similarity(ws1, ws2))
         except Exception as e:
             return JSONResponse({'error': str(e)}, status_code=500)
 
     @app.get("/similarity/")
-    def similarity(lang: str, w1: str, w2: str):
+    def similarity(request: Request, lang: str, w1: str, w2: str):
         try:
-            res = {'w1': w1, 'w2': w2, 'score': models[lang].L.similarity(w1, w2).item()}
+            model = request.state.models[lang]
+            res = {'w1': w1, 'w2': w2, 'score': model.similarity(w1, w2).item()}
             return JSONResponse(json.dumps(res))
         except Exception as e:
             return JSONResponse({'error': str(e)}, status_code=500)
 
     @app.get("/most_similar/")
-    def most_similar(lang: str, positive: List[str] = Query([]), negative: List[str] = Query([]), topn: int = 10):
+    def most_similar(request: Request, lang: str, positive: List[str] = Query([]), negative: List[str] = Query([]),
+                     topn: int = 10, approximate: bool = False):
         try:
-            positive = filter_words(lang, positive)
-            negative = filter_words(lang, negative)
-            res = models[lang].L.most_similar_cosmul(positive=positive, negative=negative, topn=topn)
-            return JSONResponse(json.dumps(res))
+            model = request.state.models[lang]
+            positive = filter_words(model, positive)
+            negative = filter_words(model, negative)
+            key = ('most_similar', lang, tuple(sorted(positive)), tuple(sorted(negative)), topn, approximate)
+            return cached(key, lambda: json.dumps(model.most_similar(positive=positive, negative=negative, topn=topn,
+                                                                     approximate=approximate)))
         except Exception as e:
             return JSONResponse({'error': str(e)}, status_code=500)
 
     @app.get("/neighbours/")
-    def neighbours(lang: str, word: str, threshold: float = 0.8):
+    def neighbours(request: Request, lang: str, word: str, threshold: float = 0.8, approximate: bool = False,
+                   max_results: Optional[int] = None):
         try:
-            return JSONResponse(models[lang].neighbours_threshold(word, threshold))
+            model = request.state.models[lang]
+            key = ('neighbours', lang, word, threshold, approximate, max_results)
+            return cached(key, lambda: model.neighbours_threshold(word, threshold, approximate=approximate,
+                                                                  max_results=max_results))
         except Exception as e:
             return JSONResponse({'error': str(e)}, status_code=500)
 
     @app.get("/model_word_set/")
-    def model_word_set(lang: str):
+    def model_word_set(request: Request, lang: str):
         try:
-            res = models[lang].L.index2word
+            model = request.state.models[lang]
+            res = list(model.L.index2word)
             return JSONResponse(json.dumps(res))
         except Exception as e:
             return JSONResponse({'error': str(e)}, status_code=500)
 
     @app.get("/to_vector/")
-    def to_vector(lang: str, tokens: List[str] = Query([])):
+    def to_vector(request: Request, lang: str, tokens: List[str] = Query([])):
         try:
-            res = models[lang].to_vector(tokens)
+            model = request.state.models[lang]
+            res = model.to_vector(tokens)
             return JSONResponse(json.dumps(res.tolist()))
         except Exception as e:
             return JSONResponse({'error': str(e)}, status_code=500)
 
     @app.get("/theme/")
-    def theme(lang: str, words: List[str] = Query([])):
+    def theme(request: Request, lang: str, words: List[str] = Query([]), approximate: bool = False):
         try:
-            words = filter_words(lang, words)
-            res = models[lang].theme(words)
-            return JSONResponse(json.dumps(res))
+            model = request.state.models[lang]
+            words = filter_words(model, words)
+            key = ('theme', lang, tuple(sorted(words)), approximate)
+            return cached(key, lambda: json.dumps(model.theme(words, approximate=approximate)))
         except Exception as e:
             return JSONResponse({'error': str(e)}, status_code=500)
 
     @app.get("/centroid/")
-    def centroid(lang: str, words: List[str] = Query([])):
+    def centroid(request: Request, lang: str, words: List[str] = Query([])):
         try:
-            words = filter_words(lang, words)
-            res = models[lang].centroid(words)
+            model = request.state.models[lang]
+            words = filter_words(model, words)
+            res = model.centroid(words)
             return JSONResponse(json.dumps(res.tolist()))
         except Exception as e:
             return JSONResponse({'error': str(e)}, status_code=500)
 
     @app.get("/analogy/")
-    def analogy(lang: str, a: str, b: str, c: str, topn: int = 10):
+    def analogy(request: Request, lang: str, a: str, b: str, c: str, topn: int = 10):
         try:
-            return JSONResponse(models[lang].analogy(a, b, c, topn))
+            model = request.state.models[lang]
+            return cached(('analogy', lang, a, b, c, topn), lambda: model.analogy(a, b, c, topn))
         except Exception as e:
             return JSONResponse({'error': str(e)}, status_code=500)
 
     @app.get("/vector/")
-    def vector(lang: str, word: str):
+    def vector(request: Request, lang: str, word: str):
         try:
-            res = models[lang].vector(word)
+            model = request.state.models[lang]
+            res = model.vector(word)
             return JSONResponse(json.dumps(res.tolist()))
         except Exception as e:
             return JSONResponse({'error': str(e)}, status_code=500)
 
+    @app.post("/vectors/")
+    def vectors(request: Request, lang: str, words: List[str] = Body(...)):
+        try:
+            model = request.state.models[lang]
+            return Response(encode_array(model.vectors(words)), media_type='application/octet-stream')
+        except Exception as e:
+            return JSONResponse({'error': str(e)}, status_code=500)
+
+    @app.post("/similarity_batch/")
+    def similarity_batch(request: Request, lang: str, pairs: List[List[str]] = Body(...)):
+        try:
+            model = request.state.models[lang]
+            return Response(encode_array(model.similarity_batch(pairs)), media_type='application/octet-stream')
+        except Exception as e:
+            return JSONResponse({'error': str(e)}, status_code=500)
+
+    @app.post("/neighbours_batch/")
+    def neighbours_batch(request: Request, lang: str, words: List[str] = Body(...), topn: int = 50):
+        try:
+            model = request.state.models[lang]
+            return JSONResponse(model.neighbours_batch(words, topn=topn))
+        except Exception as e:
+            return JSONResponse({'error': str(e)}, status_code=500)
+
     @app.get("/align/")
-    def align(lang1: str, lang2: str, word: str, topn: int = 10):
+    def align(request: Request, lang1: str, lang2: str, word: str, topn: int = 10, approximate: bool = False):
         try:
-            res = Embeddings.align(models[lang1], models[lang2], word=word, topn=topn)
-            return JSONResponse(json.dumps(res))
+            e1, e2 = request.state.models[lang1], request.state.models[lang2]
+            key = ('align', lang1, lang2, word, topn, approximate)
+            return cached(key, lambda: json.dumps(Embeddings.align(e1, e2, word=word, topn=topn,
+                                                                   approximate=approximate)))
         except Exception as e:
             return JSONResponse({'error': str(e)}, status_code=500)
 
     @app.get("/vocabulary/")
-    def vocabulary(lang: str):
+    def vocabulary(request: Request, lang: str):
         try:
-            return JSONResponse(models[lang].L.index2word)
+            model = request.state.models[lang]
+            return JSONResponse(list(model.L.index2word))
         except Exception as e:
             return JSONResponse({'error': str(e)}, status_code=500)
 
     return app
 
 
-class EmbeddingsAPI:
-    def __init__(self, host='http://localhost', port=1337, path=''):
-        self.host = host
-        self.port = port
-        self.path = path
-        self.baseurl = host + ':' + str(port) + path
+def SharedEmbeddingsServer():
+    """
+    Application factory of the workers started by `python -m semeval.server --workers N`. The models were loaded once
+     into shared memory by the parent process and are attached here read-only. Each worker has its own result cache.
+    """
+    from semeval import shared
+    options = json.loads(os.environ.get(shared.OPTIONS_VAR, '{}'))
+    return EmbeddingsServer(models=shared.attach_embeddings(json.loads(os.environ[shared.ENV_VAR])), **options)
+
 
+class EmbeddingsAPI(ServiceAPI):
     def n_similarity(self, ws1, ws2, lang='eng'):
-        url = self.baseurl + '/n_similarity'
+        url = self.baseurl + '/n_similarity/'
         content = self.get_response(url, {
             'ws1': ws1,
             'ws2': ws2,
@@ -155,7 +268,7 @@ class EmbeddingsAPI:
         return json.loads(content)
 
     def similarity(self, w1, w2, lang='eng'):
-        url = self.baseurl + '/similarity'
+        url = self.baseurl + '/similarity/'
         content = self.get_response(url, {
             'w1': w1,
             'w2': w2,
@@ -165,18 +278,19 @@ class EmbeddingsAPI:
             return json.loads(content)
         return None
 
-    def most_similar(self, positive, negative=[], topn=10, lang='eng'):
-        url = self.baseurl + '/most_similar'
+    def most_similar(self, positive, negative=[], topn=10, lang='eng', approximate=False):
+        url = self.baseurl + '/most_similar/'
         content = self.get_response(url, {
             'positive': positive,
             'negative': negative,
             'topn': topn,
-            'lang': lang
+            'lang': lang,
+            'approximate': approximate
         })
         return json.loads(content)
 
     def vector(self, word, lang='eng'):
-        url = self.baseurl + '/vector'
+        url = self.baseurl + '/vector/'
         content = self.get_response(url, {
             'word': word,
             'lang': lang
@@ -185,47 +299,50 @@ class EmbeddingsAPI:
         return json.loads(content)
 
     def model_word_set(self, lang='eng'):
-        url = self.baseurl + '/model_word_set'
+        url = self.baseurl + '/model_word_set/'
         content = self.get_response(url, {'lang': lang})
         return json.loads(content)
 
-    def theme(self, words, lang='eng'):
-        url = self.baseurl + '/theme'
-        content = self.get_response(url, {'words': words, 'lang': lang})
+    def theme(self, words, lang='eng', approximate=False):
+        url = self.baseurl + '/theme/'
+        content = self.get_response(url, {'words': words, 'lang': lang, 'approximate': approximate})
         return json.loads(content)
 
-    def neighbours(self, word, threshold=0.5, lang='eng'):
-        url = self.baseurl + '/neighbours'
+    def neighbours(self, word, threshold=0.5, lang='eng', approximate=False, max_results=None):
+        url = self.baseurl + '/neighbours/'
         content = self.get_response(url, {
             'word': word,
             'threshold': threshold,
-            'lang': lang
+            'lang': lang,
+            'approximate': approximate,
+            'max_results': max_results
         })
 
         return json.loads(content)
 
-    def align(self, word, lang1='eng', lang2='fin'):
-        url = self.baseurl + '/align'
+    def align(self, word, lang1='eng', lang2='fin', approximate=False):
+        url = self.baseurl + '/align/'
         content = self.get_response(url, {
             'word': word,
             'lang1': lang1,
-            'lang2': lang2
+            'lang2': lang2,
+            'approximate': approximate
         })
         return json.loads(content)
 
     def centroid(self, words, lang='eng'):
-        url = self.baseurl + '/centroid'
+        url = self.baseurl + '/centroid/'
         content = self.get_response(url, {'words': words, 'lang': lang})
         return json.loads(content)
 
     def to_vector(self, tokens, lang='eng'):
-        url = self.baseurl + '/to_vector'
+        url = self.baseurl + '/to_vector/'
         content = self.get_response(url, {'tokens': tokens, 'lang': lang})
 
         return json.loads(content)
 
     def analogy(self, a, b, c, topn=10, lang='eng'):
-        url = self.baseurl + '/analogy'
+        url = self.baseurl + '/analogy/'
         content = self.get_response(url, {
             'a': a,
             'b': b,
@@ -237,19 +354,24 @@ class EmbeddingsAPI:
         return json.loads(content)
 
     def vocabulary(self, lang='eng'):
-        url = self.baseurl + '/vocabulary'
+        url = self.baseurl + '/vocabulary/'
         content = self.get_response(url, {'lang': lang})
         return json.loads(content)
 
-    def get_response(self, url, params={}):
-        response = requests.get(url, params)
-        if response.status_code != 200:
-            content = json.loads(response.content)
-            if 'error' in content:
-                raise Exception(content['error'])
-            else:
-                raise Exception("Error... Response received: {}".format(content))
-        return response.content
+    def vectors(self, words, lang='eng'):
+        url = self.baseurl + '/vectors/'
+        content = self.post_response(url, {'lang': lang}, words)
+        return decode_array(content)
+
+    def similarity_batch(self, pairs, lang='eng'):
+        url = self.baseurl + '/similarity_batch/'
+        content = self.post_response(url, {'lang': lang}, [list(p) for p in pairs])
+        return decode_array(content)
+
+    def neighbours_batch(self, words, topn=50, lang='eng'):
+        url = self.baseurl + '/neighbours_batch/'
+        content = self.post_response(url, {'lang': lang, 'topn': topn}, words)
+        return json.loads(content)
 
 
 def test():
@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+LOADING, LOADED, FAILED = 'loading', 'loaded', 'failed'
+# state of a request for languages whose models cannot be loaded together within the memory budget
+TOO_LARGE = 'too_large'
+
+
+def files_size(paths):
+    """
+    The total size of files in bytes, None if one of them does not exist. Estimates the size of a model from the arrays
+     it is loaded from.
+    """
+    if not all(os.path.isfile(path) for path in paths):
+        return None
+    return sum(os.path.getsize(path) for path in paths)
+
+
+class ModelManager(object):
+    """
+    Loads the models of the languages in background threads, so that requests are never blocked by a load, and keeps
+     the loaded models within a memory budget by unloading the least recently used languages. Room is made before a
+     model is loaded, from the size it had when it was last loaded or from `estimate`. The languages of the requests in
+     flight (see `acquire`) are never unloaded, so the budget can be exceeded while they are all in use.
+
+    :param loader: function loading the model of a language
+    :param size: function returning the memory used by a model in bytes
+    :param memory_budget: maximum total size of the loaded models in bytes (None for no limit)
+    :param models: already loaded models, they are never unloaded (e.g. attached from shared memory)
+    :param on_load: function called with the language and the seconds taken after every successful load
+    :param estimate: function returning the expected size of the model of a language in bytes before it is loaded,
+     or None when it is unknown
+    """
+
+    def __init__(self, loader, size, memory_budget=None, models=None, on_load=None, estimate=None):
+        self.loader = loader
+        self.size = size
+        self.on_load = on_load
+        self.estimate = estimate
+        self.memory_budget = memory_budget
+        self._models = OrderedDict()  # least recently used first
+        self._status = {}
+        self._sizes = {}  # size of the models when they were last loaded, kept after they are unloaded
+        self._active = {}  # language: number of requests in flight using its model
+        self._lock = threading.RLock()
+        for lang, model in (models or {}).items():
+            self._models[lang] = model
+            self._status[lang] = {'state': LOADED, 'size': self.size(model), 'load_time': 0.0, 'pinned': True}
+
+    def request(self, lang):
+        """
+        The status of the model of a language, with its `state` and the `error` of a failed load. Starts loading the
+         model in the background if it is not loaded; a failed load is reported once and retried on the next request.
+        """
+        with self._lock:
+            if lang not in self._status:
+                self.load(lang)
+            status = self._status[lang]
+            if status['state'] == FAILED:
+                del self._status[lang]
+            elif status['state'] == LOADED:
+                self._models.move_to_end(lang)
+            return dict(status)
+
+    def acquire(self, langs):
+        """
+        Takes the models of languages for a request, which must give them back with `release` once answered; they are
+         not unloaded in between. Returns the status of the first language whose model is not loaded (see `request`)
+         with its `lang`, or the loaded state with the `models` by language. When the models are too large to be
+         loaded together within the memory budget, the state is `TOO_LARGE` and no model is loaded, as they would
+         unload each other.
+        """
+        langs = list(OrderedDict.fromkeys(langs))
+        with self._lock:
+            if self.memory_budget is not None and len(langs) > 1:
+                needed = sum(self.expected_size(lang) or 0 for lang in langs)
+                if needed > self.memory_budget:
+                    return {'state': TOO_LARGE,
+                            'error': "The models of languages {} need {} bytes together, more than the memory budget "
+                                     "of {} bytes".format(', '.join(langs), needed, self.memory_budget)}
+            statuses = [self.request(lang) for lang in langs]  # starts loading all of them
+            for lang, status in zip(langs, statuses):
+                if status['state'] != LOADED:
+                    return dict(status, lang=lang)
+            for lang in langs:
+                self._active[lang] = self._active.get(lang, 0) + 1
+            return {'state': LOADED, 'models': {lang: self._models[lang] for lang in langs}}
+
+    def release(self, langs):
+        with self._lock:
+            for lang in OrderedDict.fromkeys(langs):
+                self._active[lang] -= 1
+                if not self._active[lang]:
+                    del self._active[lang]
+
+    def expected_size(self, lang):
+        """
+        The size of the model of a language when it was last loaded, or its `estimate`, None if it is unknown.
+        """
+        if lang in self._sizes:
+            return self._sizes[lang]
+        return self.estimate(lang) if self.estimate is not None else None
+
+    def load(self, lang):
+        with self._lock:
+            if lang in self._status and self._status[lang]['state'] != FAILED:
+                return
+            expected = self.expected_size(lang) or 0
+            self._evict(expected, keep=lang)  # before the load, so that the budget holds while the model is read
+            self._status[lang] = {'state': LOADING, 'started': time.time(), 'expected_size': expected}
+        threading.Thread(target=self._load, args=(lang,), daemon=True).start()
+
+    def _load(self, lang):
+        start = time.time()
+        try:
+            model = self.loader(lang)
+        except Exception as e:
+            with self._lock:
+                self._status[lang] = {'state': FAILED, 'error': str(e)}
+            return
+
+        load_time = time.time() - start
+        with self._lock:
+            self._models[lang] = model
+            self._status[lang] = {'state': LOADED, 'size': self.size(model), 'load_time': load_time, 'pinned': False}
+            self._sizes[lang] = self._status[lang]['size']
+            self._evict(0, keep=lang)  # the estimate can be too small
+        if self.on_load is not None:
+            self.on_load(lang, load_time)
+
+    def _evict(self, needed, keep):
+        """
+        Unloads the least recently used models, except `keep` and the models in use, until `needed` more bytes fit in
+         the memory budget along with the models being loaded.
+        """
+        for lang in list(self._models):
+            if self.memory_budget is None or self._reserved() + needed <= self.memory_budget:
+                return
+            if lang != keep and not self._status[lang]['pinned'] and lang not in self._active:
+                del self._models[lang]
+                del self._status[lang]
+
+    def _reserved(self):
+        return self.memory_used() + sum(s['expected_size'] for s in self._status.values() if s['state'] == LOADING)
+
+    def memory_used(self):
+        with self._lock:
+            return sum(s.get('size', 0) for s in self._status.values() if s['state'] == LOADED)
+
+    def status(self):
+        with self._lock:
+            return {'memory_used': self.memory_used(), 'memory_budget': self.memory_budget,
+                    'models': {lang: dict(s) for lang, s in self._status.items()}}
+
+    def __getitem__(self, lang):
+        return self._models[lang]
+
+    def __contains__(self, lang):
+        return lang in self._models
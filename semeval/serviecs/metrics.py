@@ -0,0 +1,200 @@
+import os
+import threading
+import time
+from semeval.common import add_timing_hook, remove_timing_hook
+
+# upper bounds of the buckets of the latency histograms in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels) + '}'
+
+
+def _value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metrics(object):
+    """
+    Thread-safe counters, gauges and histograms of a service, rendered in the Prometheus text exposition format. Each
+     metric is declared once with `counter`, `gauge` or `histogram` and then updated per set of labels.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._metrics = {}  # name: (type, help, {labels: value or [bucket counts, sum, count]})
+        self._timing_hooks = {}
+
+    def _declare(self, kind, name, help):
+        with self._lock:
+            self._metrics.setdefault(name, (kind, help, {}))
+
+    def counter(self, name, help):
+        self._declare('counter', name, help)
+
+    def gauge(self, name, help):
+        self._declare('gauge', name, help)
+
+    def histogram(self, name, help):
+        self._declare('histogram', name, help)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._metrics[name][2]
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._metrics[name][2][tuple(sorted(labels.items()))] = value
+
+    def reset(self, name):
+        with self._lock:
+            self._metrics[name][2].clear()
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._metrics[name][2]
+            if key not in values:
+                values[key] = [[0] * len(self.buckets), 0.0, 0]
+            h = values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    h[0][i] += 1
+                    break
+            h[1] += value
+            h[2] += 1
+
+    def timing_hook(self, name):
+        """
+        The function recording the phase timings of `semeval.common.add_timing_hook` in the histogram `name` by method
+         and phase. It is the same function on every call, so that it is registered once.
+        """
+        with self._lock:
+            if name not in self._timing_hooks:
+                self._timing_hooks[name] = lambda method, phase, seconds: self.observe(name, seconds, method=method,
+                                                                                        phase=phase)
+            return self._timing_hooks[name]
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help, values) in sorted(self._metrics.items()):
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for key, value in sorted(values.items()):
+                    if kind != 'histogram':
+                        lines.append('{}{} {}'.format(name, _labels(key), _value(value)))
+                        continue
+                    counts, total, count = value
+                    cumulative = 0
+                    for bound, n in zip(self.buckets, counts):
+                        cumulative += n
+                        lines.append('{}_bucket{} {}'.format(name, _labels(key + (('le', repr(bound)),)), cumulative))
+                    lines.append('{}_bucket{} {}'.format(name, _labels(key + (('le', '+Inf'),)), count))
+                    lines.append('{}_sum{} {}'.format(name, _labels(key), repr(total)))
+                    lines.append('{}_count{} {}'.format(name, _labels(key), count))
+        return '\n'.join(lines) + '\n'
+
+
+def resident_memory():
+    """
+    The resident set size of the process in bytes, which includes the pages of memory-mapped models read so far, or
+     None where it cannot be read.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        import resource
+        import sys
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # the peak, in KB on Linux and bytes on macOS
+        return rss if sys.platform == 'darwin' else rss * 1024
+    except ImportError:
+        return None
+
+
+def service_metrics():
+    """
+    The metrics of a service, with the model load durations which the `ModelManager` reports through `on_load`.
+    """
+    metrics = Metrics()
+    metrics.histogram('semeval_request_duration_seconds', 'Time spent answering requests, by endpoint.')
+    metrics.counter('semeval_requests_total', 'Requests answered, by endpoint and status code.')
+    metrics.counter('semeval_request_errors_total', 'Requests answered with a server error, by endpoint.')
+    metrics.histogram('semeval_model_load_duration_seconds', 'Time spent loading the model of a language.')
+    metrics.histogram('semeval_phase_duration_seconds',
+                      'Time spent in the lookup, compute and serialize phases of the library methods, when enabled.')
+    metrics.gauge('semeval_model_bytes', 'Memory used by the loaded model of a language.')
+    metrics.gauge('semeval_model_loaded', 'Whether the model of a language is loaded (1) or loading (0).')
+    metrics.gauge('semeval_models_memory_bytes', 'Memory used by all loaded models.')
+    metrics.gauge('process_resident_memory_bytes', 'Resident memory size of the process.')
+    return metrics
+
+
+def add_metrics_route(app, models, metrics, timings=False):
+    """
+    Records the latency and the status of every request and serves the metrics at `/metrics/` in the Prometheus text
+     format, with the state and size of the models of `models` (a `ModelManager`) and the memory of the process. Add it
+     after the other middlewares, so that the time spent waiting in them is measured too.
+
+    :param timings: also record the phase timings of the `Embeddings` and `Relatedness` methods (see
+     `semeval.common.add_timing_hook`) until the app shuts down
+    """
+    from fastapi import Request
+    from fastapi.responses import Response
+
+    paths = []
+
+    def endpoint(request):
+        if not paths:
+            paths.extend(route.path for route in app.routes)
+        path = request.url.path
+        if path not in paths and path + '/' in paths:  # redirected to the endpoint
+            path += '/'
+        return path if path in paths else 'other'  # bounds the number of label values
+
+    @app.middleware("http")
+    async def record_metrics(request: Request, call_next):
+        start = time.perf_counter()
+        name = endpoint(request)
+        try:
+            response = await call_next(request)
+        except Exception:
+            metrics.inc('semeval_requests_total', endpoint=name, status=500)
+            metrics.inc('semeval_request_errors_total', endpoint=name)
+            raise
+        metrics.observe('semeval_request_duration_seconds', time.perf_counter() - start, endpoint=name)
+        metrics.inc('semeval_requests_total', endpoint=name, status=response.status_code)
+        if response.status_code >= 500 and response.status_code != 503:  # 503 answers requests for a loading model
+            metrics.inc('semeval_request_errors_total', endpoint=name)
+        return response
+
+    if timings:
+        hook = add_timing_hook(metrics.timing_hook('semeval_phase_duration_seconds'))
+        app.router.on_shutdown.append(lambda: remove_timing_hook(hook))
+
+    @app.get("/metrics/")
+    def metrics_text():
+        status = models.status()
+        metrics.reset('semeval_model_loaded')  # unloaded languages are dropped
+        metrics.reset('semeval_model_bytes')
+        for lang, s in status['models'].items():
+            metrics.set('semeval_model_loaded', 1 if s['state'] == 'loaded' else 0, lang=lang)
+            if 'size' in s:
+                metrics.set('semeval_model_bytes', s['size'], lang=lang)
+        metrics.set('semeval_models_memory_bytes', status['memory_used'])
+        rss = resident_memory()
+        if rss is not None:
+            metrics.set('process_resident_memory_bytes', rss)
+        return Response(metrics.render(), media_type=PROMETHEUS_CONTENT_TYPE)
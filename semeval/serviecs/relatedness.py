@@ -0,0 +1,194 @@
+from typing import List, Union
+import json
+from semeval.common import *
+from semeval.serviecs.manager import ModelManager, files_size
+from semeval.serviecs.common import add_loading_middleware, add_status_routes, ResponseCache, ServiceAPI
+from semeval.serviecs.metrics import add_metrics_route, service_metrics
+
+
+def relatedness_size(r):
+    m = r.matrix
+    vocab = r.rows.nbytes + (r.cols.nbytes if r.cols is not r.rows else 0)
+    return m.data.nbytes + m.indices.nbytes + m.indptr.nbytes + vocab + \
+        (r.row_norms.nbytes if r.row_norms is not None else 0)
+
+
+def relatedness_estimate(lang):
+    """
+    The size of the compiled CSR arrays of the relatedness matrix of a language, or None if it is not compiled.
+    """
+    from semeval import convert
+    paths = convert.relatedness_paths(lang)
+    return files_size([paths[k] for k in ['data', 'indices', 'indptr', 'norms']])
+
+
+# endpoints whose results are cached by default
+CACHED_ENDPOINTS = ['get_sorted_rel', 'interpret']
+
+
+def _sorted_rel(model, word, k, normalize):
+    row = model.get_sorted_rel(word, normalize=normalize, k=k)
+    return [(w, float(s)) for w, s in row] if row is not None else None
+
+
+def _scores(scores):
+    return [float(s) for s in scores] if isinstance(scores, tuple) else float(scores)
+
+
+def RelatednessServer(*args, **kwargs):
+    """
+    Serves `Relatedness` models. One copy of the matrix of each language is loaded per server, in the background on
+     the first request for the language. The batch endpoints fetch the row of every distinct word once.
+
+    :param mmap: open the compiled matrices (see `python -m semeval.convert -m relatedness`) with memory mapping
+    :param cache_size: number of results of the expensive endpoints kept in an LRU cache (0 to disable it)
+    :param cache_bytes: bound of the size of the cached response bodies in bytes
+    :param cache_ttl: seconds a cached result is served for
+    :param cache_endpoints: endpoints whose results are cached (default: `CACHED_ENDPOINTS`)
+    :param memory_budget: maximum memory used by the loaded models in MB, the least recently used languages are
+     unloaded to stay within it
+    :param retry_after: seconds after which clients are told to retry while a model is loading
+    :param timings: export the phase timings of the `Relatedness` methods at `/metrics/` along with the request metrics
+    """
+    # imported here, so that the client `RelatednessAPI` loads neither the web framework nor the model dependencies
+    from fastapi import FastAPI, Query, Body, Request
+    from fastapi.responses import JSONResponse
+    from semeval.relatedness import Relatedness
+
+    mmap = kwargs.get('mmap', False)
+    budget = kwargs.get('memory_budget')
+    metrics = service_metrics()
+    models = ModelManager(lambda lang: Relatedness(lang, mmap=mmap), size=relatedness_size,
+                          memory_budget=budget * 1024 * 1024 if budget else None, models=kwargs.get('models'),
+                          estimate=relatedness_estimate,
+                          on_load=lambda lang, seconds: metrics.observe('semeval_model_load_duration_seconds', seconds,
+                                                                        lang=lang))
+    app = FastAPI()
+    cached = ResponseCache(kwargs.get('cache_size'), kwargs.get('cache_bytes'), kwargs.get('cache_ttl'),
+                           endpoints=kwargs.get('cache_endpoints') or CACHED_ENDPOINTS)
+
+    for lang in kwargs.get('languages') or []:  # preloaded in the background
+        if lang not in models:
+            models.load(lang)
+
+    add_loading_middleware(app, models, supported_languages(), retry_after=kwargs.get('retry_after') or 5)
+    add_metrics_route(app, models, metrics, timings=kwargs.get('timings', False))
+    add_status_routes(app, models, cached)
+
+    @app.get("/get_sorted_rel/")
+    def get_sorted_rel(request: Request, lang: str, word: str, k: int = 0, normalize: bool = True):
+        try:
+            model = request.state.models[lang]
+            key = ('get_sorted_rel', lang, word, k, normalize)
+            return cached(key, lambda: _sorted_rel(model, word, k, normalize))
+        except Exception as e:
+            return JSONResponse({'error': str(e)}, status_code=500)
+
+    @app.get("/interpret/")
+    def interpret(request: Request, lang: str, tenor: str, vehicle: str, topn: int = 0):
+        try:
+            model = request.state.models[lang]
+            key = ('interpret', lang, tenor, vehicle, topn)
+            return cached(key, lambda: model.interpret_many([(tenor, vehicle)], topn=topn)[0])
+        except Exception as e:
+            return JSONResponse({'error': str(e)}, status_code=500)
+
+    @app.get("/metaphoricity/")
+    def metaphoricity(request: Request, lang: str, tenor: str, vehicle: str, expression: List[str] = Query([]),
+                      k: int = 0, normalize: bool = True):
+        try:
+            model = request.state.models[lang]
+            return JSONResponse(_scores(model.metaphoricity(tenor, vehicle, expression, k, normalize)))
+        except Exception as e:
+            return JSONResponse({'error': str(e)}, status_code=500)
+
+    @app.post("/get_sorted_rel_batch/")
+    def get_sorted_rel_batch(request: Request, lang: str, words: List[str] = Body(...), k: int = 0,
+                             normalize: bool = True):
+        try:
+            model = request.state.models[lang]
+            rows = {word: _sorted_rel(model, word, k, normalize) for word in set(words)}
+            return JSONResponse([rows[word] for word in words])
+        except Exception as e:
+            return JSONResponse({'error': str(e)}, status_code=500)
+
+    @app.post("/interpret_batch/")
+    def interpret_batch(request: Request, lang: str, pairs: List[List[str]] = Body(...), topn: int = 0):
+        try:
+            model = request.state.models[lang]
+            return JSONResponse(model.interpret_many([tuple(p) for p in pairs], topn=topn))
+        except Exception as e:
+            return JSONResponse({'error': str(e)}, status_code=500)
+
+    @app.post("/metaphoricity_batch/")
+    def metaphoricity_batch(request: Request, lang: str, records: List[Union[dict, list]] = Body(...), k: int = 0,
+                            normalize: bool = True):
+        try:
+            model = request.state.models[lang]
+            scores = model.metaphoricity_many(records, k=k, normalize=normalize)
+            return JSONResponse([_scores(s) for s in scores])
+        except Exception as e:
+            return JSONResponse({'error': str(e)}, status_code=500)
+
+    return app
+
+
+class RelatednessAPI(ServiceAPI):
+    """
+    Client of the relatedness service started with `python -m semeval.server --service relatedness`.
+    """
+
+    def get_sorted_rel(self, word, k=0, normalize=True, lang='eng'):
+        url = self.baseurl + '/get_sorted_rel/'
+        content = self.get_response(url, {'word': word, 'k': k, 'normalize': normalize, 'lang': lang})
+        return _tuples(json.loads(content))
+
+    def interpret(self, tenor, vehicle, topn=0, lang='eng'):
+        url = self.baseurl + '/interpret/'
+        content = self.get_response(url, {'tenor': tenor, 'vehicle': vehicle, 'topn': topn, 'lang': lang})
+        return _tuples(json.loads(content))
+
+    def metaphoricity(self, tenor, vehicle, expression, k=0, normalize=True, lang='eng'):
+        url = self.baseurl + '/metaphoricity/'
+        content = self.get_response(url, {'tenor': tenor, 'vehicle': vehicle, 'expression': expression, 'k': k,
+                                          'normalize': normalize, 'lang': lang})
+        return _scores_tuple(json.loads(content))
+
+    def get_sorted_rel_batch(self, words, k=0, normalize=True, lang='eng'):
+        url = self.baseurl + '/get_sorted_rel_batch/'
+        content = self.post_response(url, {'k': k, 'normalize': normalize, 'lang': lang}, list(words))
+        return [_tuples(row) for row in json.loads(content)]
+
+    def interpret_batch(self, pairs, topn=0, lang='eng'):
+        url = self.baseurl + '/interpret_batch/'
+        content = self.post_response(url, {'topn': topn, 'lang': lang}, [list(p) for p in pairs])
+        return [_tuples(row) for row in json.loads(content)]
+
+    def metaphoricity_batch(self, records, k=0, normalize=True, lang='eng'):
+        """
+        :param records: (tenor, vehicle, expression) tuples or dicts with these keys
+        """
+        url = self.baseurl + '/metaphoricity_batch/'
+        records = [r if isinstance(r, dict) else list(r) for r in records]
+        content = self.post_response(url, {'k': k, 'normalize': normalize, 'lang': lang}, records)
+        return [_scores_tuple(s) for s in json.loads(content)]
+
+
+def _tuples(rows):
+    return [tuple(r) for r in rows] if rows is not None else None
+
+
+def _scores_tuple(scores):
+    return tuple(scores) if isinstance(scores, list) else scores
+
+
+def test():
+    api = RelatednessAPI()
+    print(api.get_sorted_rel('car', k=5))
+    print(api.interpret('alcohol', 'crutch', topn=10))
+    print(api.metaphoricity('computer', 'creative', ['the', 'algorithm', 'for', 'painting'], 300))
+    print(api.interpret_batch([('alcohol', 'crutch'), ('cloud', 'cotton')], topn=10))
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,102 @@
+import sys
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+from .common import *
+
+# environment variable through which the parent process tells the workers where the shared models are
+ENV_VAR = 'SEMEVAL_SHARED_MODELS'
+# environment variable holding the other options of the server, as JSON
+OPTIONS_VAR = 'SEMEVAL_SERVER_OPTIONS'
+
+# shared memory blocks attached by this process, they must stay open as long as the arrays are used
+_attached = []
+
+
+def _open(name):
+    # the parent owns the blocks: attaching must not register them with the resource tracker, which spawned workers
+    # share with the parent and which would otherwise unlink them (or warn) when a worker exits
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def share_array(arr):
+    """
+    Copies an array into a new shared memory block. Returns the block and a JSON-serializable description of it.
+    """
+    arr = np.ascontiguousarray(arr)
+    block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)[...] = arr
+    return block, {'name': block.name, 'shape': list(arr.shape), 'dtype': arr.dtype.str}
+
+
+def attach_array(spec):
+    """
+    Attaches to an array shared by `share_array` without copying it. The returned array is read-only.
+    """
+    block = _open(spec['name'])
+    _attached.append(block)
+    arr = np.ndarray(tuple(spec['shape']), dtype=np.dtype(spec['dtype']), buffer=block.buf)
+    arr.flags.writeable = False
+    return arr
+
+
+def share_embeddings(languages, mmap=False, max_vocab=None):
+    """
+    Loads the embeddings of the given languages once and copies their vectors, normalized vectors and the arrays of
+     their `Vocabulary` into shared memory. Memory-mapped models (`mmap=True`) are not copied: the workers open the
+     compiled files, which they share through the OS page cache. Returns the specification to pass to
+     `attach_embeddings` and the blocks, which the caller must close and unlink once the workers are done.
+    """
+    from .embeddings import Embeddings, VocabDict
+    from .vocabulary import Vocabulary, ARRAYS
+
+    spec, blocks = {}, []
+    for lang in languages:
+        e = Embeddings(lang, mmap=mmap, max_vocab=max_vocab)  # also checks that the compiled files can be opened
+        if mmap:
+            spec[lang] = {'mmap': True, 'max_vocab': max_vocab}
+            continue
+        e.L.init_sims()
+        if isinstance(e.L.vocab, VocabDict):
+            vocab = e.L.vocab.vocabulary
+        else:
+            vocab = Vocabulary.from_terms(e.L.index2word)
+        blob = np.frombuffer(vocab.blob, dtype=np.uint8)
+        spec[lang] = {}
+        arrays = [('vectors', e.L.vectors), ('norm', e.L.vectors_norm), ('blob', blob)]
+        for k, arr in arrays + [(name, getattr(vocab, name)) for name in ARRAYS]:
+            block, spec[lang][k] = share_array(arr)
+            blocks.append(block)
+        del e
+    return spec, blocks
+
+
+def attach_embeddings(spec):
+    """
+    Builds read-only `Embeddings` objects on top of the shared memory described by `spec`. The words are looked up in
+     the shared `Vocabulary` arrays, so no worker builds a dict of them.
+    """
+    from .embeddings import Embeddings
+    from .vocabulary import Vocabulary, ARRAYS
+
+    models = {}
+    for lang, arrays in spec.items():
+        if arrays.get('mmap'):
+            models[lang] = Embeddings(lang, mmap=True, max_vocab=arrays['max_vocab'])
+            continue
+        vocab = Vocabulary(attach_array(arrays['blob']).data, *[attach_array(arrays[name]) for name in ARRAYS])
+        models[lang] = Embeddings.from_vectors(lang, vocab, attach_array(arrays['vectors']),
+                                               attach_array(arrays['norm']))
+    return models
+
+
+def release(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
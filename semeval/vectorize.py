@@ -0,0 +1,215 @@
+import argparse
+import io
+import json
+import multiprocessing
+import numpy as np
+from collections import deque
+from scipy import sparse
+from .common import *
+
+# what the vector of a document without any word of the model is
+EMPTY_POLICIES = ['zeros', 'nan', 'raise']
+
+# the state used by the worker processes of `vectorize`, inherited when they are forked
+_pool_state = None
+
+
+def read_documents(path):
+    """
+    Streams the documents of a file as token lists. In a `.jsonl` file every line is a list of tokens, or an object with
+     a `tokens` list or a `text` string; in any other file every line is a document. Text is split on whitespace.
+    """
+    with io.open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if not line.strip():
+                    continue
+                doc = json.loads(line)
+                if isinstance(doc, dict):
+                    doc = doc['tokens'] if 'tokens' in doc else doc['text']
+                yield doc.split() if isinstance(doc, str) else doc
+        else:
+            for line in f:
+                yield line.split()
+
+
+def _batches(documents, batch_size):
+    batch = []
+    for doc in documents:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def lookup(vocab, tokens):
+    """
+    The rows of the tokens in the vectors, -1 for the words out of the model. Every distinct token is looked up once, in
+     one call to `Vocabulary.indices` when the model's vocabulary is memory-mapped or shared.
+
+    :param vocab: the vocabulary of the model, `Embeddings.L.vocab`
+    """
+    from .embeddings import VocabDict
+
+    positions = dict.fromkeys(tokens)
+    for i, t in enumerate(positions):
+        positions[t] = i
+    ids = np.fromiter(map(positions.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+    if isinstance(vocab, VocabDict):
+        rows = vocab.vocabulary.indices(positions)
+    else:
+        rows = np.fromiter((vocab[t].index if t in vocab else -1 for t in positions), dtype=np.int64,
+                           count=len(positions))
+    return rows[ids]
+
+
+def document_matrix(vocab, documents, n_words):
+    """
+    The sparse documents x vocabulary matrix whose product with the vectors averages the vectors of the words of each
+     document, and the number of words of the model in each document.
+
+    :param vocab: the vocabulary of the model, see `lookup`
+    """
+    lengths = [len(doc) for doc in documents]
+    words = lookup(vocab, [t for doc in documents for t in doc])
+    rows = np.repeat(np.arange(len(documents)), lengths)
+    known = words >= 0
+    rows, words = rows[known], words[known]
+    counts = np.bincount(rows, minlength=len(documents))
+    data = (1.0 / counts[rows]).astype(np.float32)
+    return sparse.csr_matrix((data, (rows, words)), shape=(len(documents), n_words)), counts
+
+
+def _vectorize_batch(vectors, vocab, documents, empty, n_words):
+    matrix, counts = document_matrix(vocab, documents, n_words)
+    if isinstance(vectors, np.ndarray):
+        result = np.asarray(matrix.dot(vectors), dtype=np.float32)
+    else:  # quantized vectors, only the rows of the words of the batch are decoded
+        used = np.unique(matrix.indices)
+        result = np.asarray(matrix[:, used].dot(vectors.vectors(used)), dtype=np.float32)
+    if empty == 'raise' and not counts.all():
+        raise Exception("No words in the text found in the model.")
+    elif empty == 'nan':
+        result[counts == 0] = np.nan
+    return result
+
+
+def _pool_batch(documents):
+    vectors, vocab, empty, n_words = _pool_state
+    return _vectorize_batch(vectors, vocab, documents, empty, n_words)
+
+
+def _imap(pool, batches, max_pending):
+    """
+    Like `pool.imap`, but reads the next batches only as the results are consumed, so that the documents are streamed.
+    """
+    pending = deque()
+    for batch in batches:
+        pending.append(pool.apply_async(_pool_batch, (batch,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class NpyWriter(object):
+    """
+    Appends rows to a `.npy` file whose number of rows is not known in advance. The header is rewritten with the final
+     shape when the writer is closed.
+    """
+    HEADER_SIZE = 128
+
+    def __init__(self, path, dim, dtype=np.float32):
+        self.path = path
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        self.f = io.open(path, 'wb')
+        self.f.write(self._header())
+
+    def _header(self):
+        header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({}, {}), }}".format(
+            self.dtype.str, self.rows, self.dim)
+        header = header.ljust(self.HEADER_SIZE - 10 - 1) + '\n'  # padded to keep the data aligned
+        return b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1')
+
+    def write(self, rows):
+        self.f.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+        self.rows += len(rows)
+
+    def close(self):
+        self.f.seek(0)
+        self.f.write(self._header())
+        self.f.close()
+
+
+def vectorize(e, documents, output=None, batch_size=10000, empty='zeros', processes=None):
+    """
+    The vectors of many documents, each the mean of the vectors of its words in the model as in `Embeddings.to_vector`.
+     The documents are streamed in batches of `batch_size`; the words of a batch are looked up at once and averaged
+     with one sparse documents x vocabulary matrix product.
+
+    :param documents: an iterable of token lists, or the path of a file read by `read_documents`
+    :param output: path of a `.npy` file the vectors are written to batch by batch instead of being kept in memory;
+     it is then returned memory-mapped
+    :param empty: the vector of a document without any word of the model: 'zeros', 'nan' or 'raise' an exception
+    :param processes: number of forked processes the batches are split across, they share the (memory-mapped) vectors
+     of `e`, which can be quantized
+    """
+    if empty not in EMPTY_POLICIES:
+        raise Exception("Unknown empty document policy '{}', use one of {}".format(empty, EMPTY_POLICIES))
+    if isinstance(documents, str):
+        documents = read_documents(documents)
+
+    vectors = e.quantized if e.quantized is not None else e.L.vectors
+    dim, n_words = e.L.vector_size, len(e.L.index2word)
+    batches = _batches(documents, batch_size)
+    writer = NpyWriter(output, dim) if output else None
+    results = []
+
+    global _pool_state
+    pool = None
+    try:
+        if processes and processes > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            _pool_state = (vectors, e.L.vocab, empty, n_words)
+            pool = multiprocessing.get_context('fork').Pool(processes)
+            vectorized = _imap(pool, batches, 2 * processes)
+        else:
+            vectorized = (_vectorize_batch(vectors, e.L.vocab, batch, empty, n_words) for batch in batches)
+
+        for batch in vectorized:
+            if writer is not None:
+                writer.write(batch)
+            else:
+                results.append(batch)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            _pool_state = None
+        if writer is not None:
+            writer.close()
+
+    if writer is not None:
+        return np.load(output, mmap_mode='r')
+    return np.concatenate(results) if results else np.empty((0, dim), dtype=np.float32)
+
+
+if __name__ == "__main__":
+    from .embeddings import Embeddings
+
+    parser = argparse.ArgumentParser(description='semeval vectorize documents as the mean of their word vectors')
+    parser.add_argument('-l', '--language', required=True, help='<Required> language of the documents')
+    parser.add_argument('-i', '--input', required=True,
+                        help='<Required> documents, one per line as text or as JSON (.jsonl) token lists')
+    parser.add_argument('-o', '--output', required=True, help='<Required> .npy file the vectors are written to')
+    parser.add_argument('--batch-size', type=int, default=10000, help='documents vectorized at a time')
+    parser.add_argument('--empty', default='zeros', choices=EMPTY_POLICIES,
+                        help='vector of the documents without known words (default: zeros)')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--mmap', action='store_true', help='open the compiled model (see semeval.convert)')
+    args = parser.parse_args()
+
+    vectorize(Embeddings(args.language, mmap=args.mmap), args.input, output=args.output, batch_size=args.batch_size,
+              empty=args.empty, processes=args.processes)
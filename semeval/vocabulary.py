@@ -0,0 +1,166 @@
+import bisect
+import filecmp
+import io
+import mmap
+import zlib
+import numpy as np
+from .common import *
+
+# the arrays of a vocabulary, saved as `{prefix}{name}.npy`, and the file of the bytes of its terms
+ARRAYS = ['offsets', 'hashes', 'order']
+BLOB = 'blob.bin'
+
+
+class Vocabulary(object):
+    """
+    An immutable term <-> index mapping stored in flat buffers instead of Python dicts and lists: the UTF-8 bytes of
+     all terms concatenated in index order, the offset of every term in them, and the CRC32 hashes of the terms sorted
+     along with the indices they belong to, which are binary searched to find a term. They can be saved and
+     memory-mapped, so that processes on the same host share one copy through the OS page cache.
+
+    It is used like the dict of term: index it replaces (`vocab[term]`, `vocab.get(term, -1)`, `term in vocab`,
+     `len(vocab)`), iterates over the terms in index order and maps indices back to terms with `term` and `terms`.
+     A term listed several times maps to its last index, as a dict built from the list would.
+    """
+
+    def __init__(self, blob, offsets, hashes, order):
+        """
+        :param blob: the bytes of the terms: `bytes`, a memory-mapped file or a memoryview (e.g. of shared memory)
+        """
+        self.blob = blob
+        self.offsets = np.asarray(offsets)
+        self.hashes = np.asarray(hashes)
+        self.order = np.asarray(order)
+        # scalar reads (and the binary search) through memoryviews use Python ints without creating numpy scalars
+        self._offsets = memoryview(self.offsets)
+        self._hashes = memoryview(self.hashes)
+        self._order = memoryview(self.order)
+
+    @classmethod
+    def from_terms(cls, terms):
+        encoded = [t.encode('utf-8') for t in terms]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+        hashes = np.fromiter(map(zlib.crc32, encoded), dtype=np.uint32, count=len(encoded))
+        order = np.argsort(hashes, kind='stable').astype(np.int64)  # equal hashes stay in index order
+        return cls(b''.join(encoded), offsets, hashes[order], order)
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Reads the terms of a file, one per line in index order; only the text before the first tab is kept.
+        """
+        with io.open(path, 'r', encoding='utf-8') as f:
+            lines = f.read().split('\n')
+        if lines and not lines[-1]:
+            lines.pop()  # the file ends with a newline
+        return cls.from_terms([line.split('\t', 1)[0] for line in lines])
+
+    def save(self, prefix):
+        with io.open(prefix + BLOB, 'wb') as f:
+            f.write(self.blob)
+        for name in ARRAYS:
+            np.save(prefix + name + '.npy', getattr(self, name))
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        """
+        :param mmap_mode: 'r' to memory-map the files, None to read them into memory
+        """
+        with io.open(prefix + BLOB, 'rb') as f:
+            if mmap_mode is not None and os.path.getsize(prefix + BLOB) > 0:  # empty files cannot be mapped
+                blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                blob = f.read()
+        return cls(blob, *[np.load(prefix + name + '.npy', mmap_mode=mmap_mode) for name in ARRAYS])
+
+    @staticmethod
+    def files(prefix):
+        return [prefix + BLOB] + [prefix + name + '.npy' for name in ARRAYS]
+
+    @staticmethod
+    def exists(prefix):
+        return all(os.path.isfile(path) for path in Vocabulary.files(prefix))
+
+    def get(self, term, default=None):
+        key = term.encode('utf-8')
+        h = zlib.crc32(key)
+        i = bisect.bisect_left(self._hashes, h)
+        found = default
+        while i < len(self._hashes) and self._hashes[i] == h:  # terms sharing the hash, in index order
+            index = self._order[i]
+            if self.blob[self._offsets[index]:self._offsets[index + 1]] == key:
+                found = index
+            i += 1
+        return found
+
+    def __getitem__(self, term):
+        index = self.get(term)
+        if index is None:
+            raise KeyError(term)
+        return index
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.term(i)
+
+    def head(self, n):
+        """
+        The vocabulary of the first `n` terms, sharing the bytes and offsets of this one.
+        """
+        keep = self.order < n
+        return Vocabulary(self.blob, self.offsets[:n + 1], self.hashes[keep], self.order[keep])
+
+    def term(self, index):
+        return str(self.blob[self._offsets[index]:self._offsets[index + 1]], 'utf-8')
+
+    def terms(self, indices):
+        """
+        The terms at the given indices, a list.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        blob = self.blob
+        return [str(blob[start:end], 'utf-8')
+                for start, end in zip(self.offsets[indices].tolist(), self.offsets[indices + 1].tolist())]
+
+    def indices(self, terms, default=-1):
+        """
+        The indices of the given terms as an array, `default` for the unknown ones. The hashes of all terms are searched
+         at once; only the terms whose hash is shared by several terms are looked up one by one.
+        """
+        terms = list(terms)
+        keys = [t.encode('utf-8') for t in terms]
+        result = np.full(len(keys), default, dtype=np.int64)
+        n = len(self.hashes)
+        if not keys or not n:
+            return result
+        hashes = np.fromiter(map(zlib.crc32, keys), dtype=np.uint32, count=len(keys))
+        pos = np.searchsorted(self.hashes, hashes)
+        found = pos < n
+        found[found] = self.hashes[pos[found]] == hashes[found]
+        shared = found & (pos + 1 < n)
+        shared[shared] = self.hashes[pos[shared] + 1] == hashes[shared]
+        single = np.flatnonzero(found & ~shared)
+        candidates = self.order[pos[single]]
+        blob = self.blob
+        for i, index, start, end in zip(single.tolist(), candidates.tolist(), self.offsets[candidates].tolist(),
+                                        self.offsets[candidates + 1].tolist()):
+            if blob[start:end] == keys[i]:
+                result[i] = index
+        for i in np.flatnonzero(shared).tolist():
+            result[i] = self.get(terms[i], default)
+        return result
+
+    @property
+    def nbytes(self):
+        return len(self.blob) + sum(getattr(self, name).nbytes for name in ARRAYS)
+
+
+def same_file(path1, path2):
+    return os.path.abspath(path1) == os.path.abspath(path2) or filecmp.cmp(path1, path2, shallow=False)
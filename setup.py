@@ -71,7 +71,7 @@ setup(
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=["mikatools", "argparse", "numpy", "gensim", "fastapi", "uvicorn", "ujson", "requests",
-                      "scikit-learn", "hickle"],
+                      "scipy", "hickle"],
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). You can install these using the following syntax,
@@ -0,0 +1,146 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+
+from semeval import download
+
+
+class FileServer(object):
+    """
+    A local stand-in of Zenodo serving `files` (path: bytes) with support for Range requests. The first response of
+     the paths in `interrupt` stops after half of the file, as a dropped connection would.
+    """
+
+    def __init__(self, files, interrupt=()):
+        self.files = files
+        self.interrupt = set(interrupt)
+        self.requests = []  # (path, Range header)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                server.requests.append((path, self.headers.get('Range')))
+                if path not in server.files:
+                    self.send_error(404)
+                    return
+                data = server.files[path]
+                start = 0
+                if self.headers.get('Range'):
+                    start = int(self.headers['Range'].split('=')[1].split('-')[0])
+                    if start >= len(data):
+                        self.send_response(416)
+                        self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+                else:
+                    self.send_response(200)
+                body = data[start:]
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if path in server.interrupt:
+                    server.interrupt.discard(path)
+                    self.wfile.write(body[:len(body) // 2])
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('localhost', 0), Handler)
+        self.url = 'http://localhost:{}'.format(self.httpd.server_address[1])
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FetchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data = os.urandom(200000)
+        self.server = FileServer({'/model.bin': self.data})
+        self.path = os.path.join(self.dir, 'model.bin')
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.dir)
+
+    def test_resumes_partial_file_with_range(self):
+        with open(self.path + '.part', 'wb') as f:
+            f.write(self.data[:50000])
+        download.fetch(self.server.url + '/model.bin', self.path)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(self.server.requests, [('/model.bin', 'bytes=50000-')])
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    def test_resumes_interrupted_download(self):
+        self.server.interrupt.add('/model.bin')
+        with mock.patch('time.sleep'):
+            download.fetch(self.server.url + '/model.bin', self.path, retries=2, chunk_size=4096)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        (_, first), (_, second) = self.server.requests
+        self.assertIsNone(first)
+        self.assertGreater(int(second.split('=')[1].rstrip('-')), 0)  # the blocks received before the drop are kept
+
+    def test_checksum(self):
+        checksum = 'md5:' + hashlib.md5(self.data).hexdigest()
+        download.fetch(self.server.url + '/model.bin', self.path, checksum=checksum)
+        self.assertTrue(download.verify(self.path, checksum))
+
+    def test_checksum_failure(self):
+        with self.assertRaises(Exception):
+            download.fetch(self.server.url + '/model.bin', self.path, checksum='md5:' + '0' * 32)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.part'))  # the next attempt starts over
+
+
+class MainTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = FileServer({'/terms.txt': b'a\nb\n', '/matrix.hkl': b'matrix'})
+        models = {'fin': {'rows': self.server.url + '/terms.txt', 'cols': self.server.url + '/terms.txt',
+                          'model': self.server.url + '/matrix.hkl'}}
+        self.patches = [mock.patch.dict(os.environ, {'SEMEVAL_DATA': self.dir}),
+                        mock.patch.dict(download.RELATEDNESS_MODELS, models)]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.server.close()
+        shutil.rmtree(self.dir)
+
+    def test_downloads_shared_url_once(self):
+        download.main(['fin'], ['relatedness'])
+        for name in ['fin-relatedness-rows.txt', 'fin-relatedness-cols.txt']:
+            with open(os.path.join(self.dir, name), 'rb') as f:
+                self.assertEqual(f.read(), b'a\nb\n')
+        self.assertEqual(sorted(path for path, _ in self.server.requests), ['/matrix.hkl', '/terms.txt'])
+
+    def test_skips_downloaded_files(self):
+        download.main(['fin'], ['relatedness'])
+        os.remove(os.path.join(self.dir, 'fin-relatedness-cols.txt'))
+        del self.server.requests[:]
+        download.main(['fin'], ['relatedness'])
+        self.assertEqual(self.server.requests, [])  # copied from the rows
+        self.assertTrue(os.path.isfile(os.path.join(self.dir, 'fin-relatedness-cols.txt')))
+
+
+if __name__ == '__main__':
+    unittest.main()
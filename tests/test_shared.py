@@ -0,0 +1,75 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import semeval
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(semeval.__file__)))
+
+# shares a block, lets spawned workers (which share the resource tracker of the parent, as uvicorn's do) attach to it
+# and exit, then releases the block or exits without releasing it as a crashed parent would
+SCRIPT = '''
+import multiprocessing
+import os
+import sys
+import numpy as np
+from semeval import shared
+
+
+def attach(spec):
+    assert shared.attach_array(spec).sum() == 45
+
+
+if __name__ == '__main__':
+    block, spec = shared.share_array(np.arange(10))
+    for _ in range(3):
+        worker = multiprocessing.get_context('spawn').Process(target=attach, args=(spec,))
+        worker.start()
+        worker.join()
+        assert worker.exitcode == 0
+    shared.attach_array(spec)  # still there after the workers exited
+    print(block.name, flush=True)
+    if sys.argv[1] == 'crash':
+        os._exit(0)
+    shared.release([block])
+'''
+
+
+class SpawnedWorkersTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.script = os.path.join(self.dir, 'share.py')
+        with open(self.script, 'w') as f:
+            f.write(SCRIPT)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_script(self, mode):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT] + sys.path))
+        result = subprocess.run([sys.executable, self.script, mode], env=env, capture_output=True, text=True,
+                                timeout=120)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return result.stdout.strip(), result.stderr
+
+    def test_release_after_workers_exit(self):
+        _, stderr = self.run_script('release')
+        self.assertNotIn('KeyError', stderr)
+        self.assertNotIn('leaked', stderr)
+
+    @unittest.skipUnless(os.path.isdir('/dev/shm'), "needs POSIX shared memory in /dev/shm")
+    def test_tracker_unlinks_blocks_of_crashed_parent(self):
+        name, _ = self.run_script('crash')
+        path = os.path.join('/dev/shm', name.lstrip('/'))
+        deadline = time.time() + 10
+        while os.path.exists(path) and time.time() < deadline:  # the tracker cleans up after the parent exited
+            time.sleep(0.1)
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()